@@ -0,0 +1,45 @@
+import argparse, json, os, time
+from utils import ensure_mkdir, period_to_seconds
+from dca_backtest import load_backtest_market_data, run_grid
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(description='Evaluate a grid of DCA parameters over OHLCV archives.')
+
+    parser.add_argument("config", type=str, help="Path to an investor json configuration file with a backtest exchange, see examples/investor-backtest-config-sample.json. endTime is required.")
+    parser.add_argument("grid", type=str, help="Path to a json file mapping investPeriod, cancelAfter, investAmount and limitOffset to lists of values, see examples/dca-grid-sample.json.")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes evaluating the grid. Default to 1.")
+    parser.add_argument("--curve-period", type=str, default="1d", help="Sampling period of equity curves. Default to 1d.")
+    parser.add_argument("--output", type=str, help="Path to a csv file receiving the statistics of each combination.")
+    parser.add_argument("--equity-curves", type=str, help="Path to a folder receiving the equity curve of each combination, as csv files named by their row in the statistics.")
+    parser.add_argument("--top", type=int, default=20, help="Number of best combinations to print. Default to 20.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_cli_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    with open(args.grid) as f:
+        grid = json.load(f)
+
+    start = time.time()
+    data = load_backtest_market_data(config, grid)
+    print("-- Loaded {} candles of {} in {:.1f} seconds".format(len(data["timestamps"]), ", ".join(data["close"].keys()), time.time() - start))
+
+    start = time.time()
+    stats, curves = run_grid(data, config, grid, fee=float(config["exchange"].get("makerFee", 0.0)),
+        spread=float(config["exchange"].get("spread", 0.001)), curve_period=int(period_to_seconds(args.curve_period)), jobs=args.jobs)
+    print("-- Evaluated {} combinations in {:.1f} seconds".format(len(stats), time.time() - start))
+
+    print(stats.sort_values("return", ascending=False).head(args.top).to_string())
+
+    if args.output:
+        stats.to_csv(args.output, index_label="combination")
+    if args.equity_curves:
+        ensure_mkdir(args.equity_curves)
+        for i, curve in enumerate(curves):
+            curve.to_csv(os.path.join(args.equity_curves, "{}.csv".format(i)))
+
+if __name__ == "__main__":
+    main()
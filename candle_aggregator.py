@@ -0,0 +1,181 @@
+import time, threading
+import pandas as pd
+from datetime import datetime, timezone
+from utils import timedelta, compute_end_timestamp
+from cbpro import WebsocketClient
+
+# Build OHLCV candles locally from trades, instead of polling the REST API of the exchange.
+# Base candles (1m by default) are built from trades, coarser candles are built from closed base candles.
+# Closed candles are appended to an OHLCV storage (see ohlcv_storage), so fetch-ohlcv can resume from them.
+# Since fetch-ohlcv only resumes after the last stored candle, candles missed during a downtime are backfilled (eg. from the
+# REST API) before the first candle of a run or of a reconnection is written.
+
+def bar_open_timestamp(timestamp, timeframe):
+    return int((compute_end_timestamp(datetime.fromtimestamp(timestamp, timezone.utc), timeframe) + timedelta('1s')).timestamp())
+
+def bar_close_timestamp(open_timestamp, timeframe):
+    if timeframe == "1M":
+        # Special case for month because it has not fixed timedelta: the close is the last second before the next month
+        d = datetime.fromtimestamp(open_timestamp, timezone.utc)
+        next_month = datetime(d.year + d.month // 12, d.month % 12 + 1, 1, tzinfo=timezone.utc)
+        return int(next_month.timestamp()) - 1
+    return open_timestamp + int(timedelta(timeframe).total_seconds()) - 1
+
+def parse_match_time(t):
+    return int(datetime.strptime(t.split(".")[0].rstrip("Z") + " UTC", '%Y-%m-%dT%H:%M:%S %Z').replace(tzinfo=timezone.utc).timestamp())
+
+class Bar:
+    __slots__ = ('open_timestamp', 'close_timestamp', 'open', 'high', 'low', 'close', 'volume', 'complete')
+
+    def __init__(self, open_timestamp, close_timestamp, open, high, low, close, volume, complete):
+        self.open_timestamp = open_timestamp
+        self.close_timestamp = close_timestamp
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.complete = complete # False if the bar was opened before the aggregator started to receive trades
+
+    def merge(self, high, low, close, volume):
+        self.high = max(self.high, high)
+        self.low = min(self.low, low)
+        self.close = close
+        self.volume += volume
+
+    def to_dataframe(self):
+        df = pd.DataFrame({
+            'close_timestamp_utc': [ self.close_timestamp ],
+            'open': [ self.open ],
+            'high': [ self.high ],
+            'low': [ self.low ],
+            'close': [ self.close ],
+            'volume': [ self.volume ]
+        }, index=[ self.open_timestamp ])
+        df.index.name = "open_timestamp_utc"
+        return df
+
+class CandleAggregator:
+    def __init__(self, storage, exchange_name, timeframes, base_timeframe="1m", on_candle=None, backfill=None):
+        self.storage = storage
+        self.exchange_name = exchange_name
+        self.base_timeframe = base_timeframe
+        self.timeframes = [ tf for tf in timeframes if tf != base_timeframe ]
+        self.on_candle = on_candle # optional callback(instrument, timeframe, bar) called for each closed candle
+        # optional callback(instrument, timeframe) appending to the storage the candles closed since the last stored one,
+        # base timeframe first
+        self.backfill = backfill
+        self._bars = {} # (instrument, timeframe) -> current Bar
+        self._start_timestamps = {} # instrument -> timestamp of the first trade received
+        self._last_close_timestamps = {} # (instrument, timeframe) -> close timestamp of the last stored candle
+        self._lock = threading.Lock()
+
+    def _is_complete(self, instrument, open_timestamp):
+        return open_timestamp >= self._start_timestamps[instrument]
+
+    def _write(self, instrument, timeframe, bar):
+        if not bar.complete:
+            return
+        key = (instrument, timeframe)
+        if not key in self._last_close_timestamps:
+            # First write since the start or the last reconnection: fill the gap after the stored candles
+            last_close_timestamp = self.storage.last_close_timestamp(self.exchange_name, instrument, timeframe)
+            if self.backfill and last_close_timestamp != None and bar.open_timestamp > last_close_timestamp + 1:
+                try:
+                    self.backfill(instrument, timeframe)
+                except Exception as e:
+                    print("[ERROR] Unable to backfill {}-{}: {}".format(instrument, timeframe, e))
+                last_close_timestamp = self.storage.last_close_timestamp(self.exchange_name, instrument, timeframe)
+            self._last_close_timestamps[key] = last_close_timestamp
+        last_close_timestamp = self._last_close_timestamps[key]
+        if last_close_timestamp != None and bar.open_timestamp <= last_close_timestamp:
+            return # already stored, eg. by fetch-ohlcv
+        self.storage.append(self.exchange_name, instrument, timeframe, bar.to_dataframe())
+        self._last_close_timestamps[key] = bar.close_timestamp
+        if self.on_candle:
+            self.on_candle(instrument, timeframe, bar)
+
+    def _close_base_bar(self, instrument, bar):
+        self._write(instrument, self.base_timeframe, bar)
+        for tf in self.timeframes:
+            key = (instrument, tf)
+            current = self._bars.get(key)
+            if current != None and bar.open_timestamp > current.close_timestamp:
+                self._write(instrument, tf, current)
+                current = None
+            if current == None:
+                open_timestamp = bar_open_timestamp(bar.open_timestamp, tf)
+                self._bars[key] = Bar(open_timestamp, bar_close_timestamp(open_timestamp, tf),
+                    bar.open, bar.high, bar.low, bar.close, bar.volume,
+                    bar.complete and self._is_complete(instrument, open_timestamp))
+            else:
+                current.merge(bar.high, bar.low, bar.close, bar.volume)
+
+    def on_trade(self, instrument, timestamp, price, size):
+        with self._lock:
+            if not instrument in self._start_timestamps:
+                self._start_timestamps[instrument] = timestamp
+            key = (instrument, self.base_timeframe)
+            bar = self._bars.get(key)
+            if bar != None and timestamp > bar.close_timestamp:
+                self._close_base_bar(instrument, bar)
+                bar = None
+            if bar == None:
+                open_timestamp = bar_open_timestamp(timestamp, self.base_timeframe)
+                self._bars[key] = Bar(open_timestamp, bar_close_timestamp(open_timestamp, self.base_timeframe),
+                    price, price, price, price, size, self._is_complete(instrument, open_timestamp))
+            else:
+                bar.merge(price, price, price, size)
+
+    def reset(self):
+        # Called on each (re)connection: trades may have been missed since the last message, so bars in progress are
+        # not written, bars are complete again from the next trade received and missed candles are backfilled
+        with self._lock:
+            for bar in self._bars.values():
+                bar.complete = False
+            self._start_timestamps = {}
+            self._last_close_timestamps = {}
+
+    def on_message(self, message):
+        # Accepts any Coinbase Pro websocket message, only matches are used
+        if message.get('type') in ('match', 'last_match') and 'time' in message:
+            self.on_trade(message['product_id'], parse_match_time(message['time']), float(message['price']), float(message['size']))
+
+    def close_bars(self, now):
+        # Close bars that ended before 'now' without waiting for the next trade, so that closed candles are written
+        # right after their end even on quiet instruments
+        with self._lock:
+            for (instrument, timeframe), bar in list(self._bars.items()):
+                if timeframe == self.base_timeframe and now > bar.close_timestamp:
+                    del self._bars[(instrument, timeframe)]
+                    self._close_base_bar(instrument, bar)
+            for (instrument, timeframe), bar in list(self._bars.items()):
+                if timeframe != self.base_timeframe and now > bar.close_timestamp:
+                    del self._bars[(instrument, timeframe)]
+                    self._write(instrument, timeframe, bar)
+
+class CandleAggregatorClient(WebsocketClient):
+    # Subscribe to the matches channel of some Coinbase Pro products and feed an aggregator.
+    # A timer thread closes bars every second using the exchange clock (exchange.get_utc_timestamp).
+    # On errors the client stops (stop is True and error is set) and can be restarted with start, bars in progress are kept.
+    def __init__(self, aggregator, products, clock=time.time):
+        super().__init__(products=products, channels=["matches"], should_print=False)
+        self.aggregator = aggregator
+        self.clock = clock
+        self._timer = None
+
+    def on_open(self):
+        print("-- Aggregating candles of {} --".format(", ".join(self.products)))
+        self.aggregator.reset()
+        if self._timer == None or not self._timer.is_alive():
+            self._timer = threading.Thread(target=self._close_bars_loop)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _close_bars_loop(self):
+        while not self.stop:
+            self.aggregator.close_bars(self.clock())
+            time.sleep(1)
+
+    def on_message(self, msg):
+        self.aggregator.on_message(msg)
@@ -300,5 +300,6 @@ def main():
 
     update_thread.stop()
     update_thread.join()
+    exchange.close()
 
 main()
\ No newline at end of file
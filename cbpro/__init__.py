@@ -3,3 +3,5 @@ from cbpro.public_client import PublicClient
 from cbpro.websocket_client import WebsocketClient
 from cbpro.order_book import OrderBook
 from cbpro.cbpro_auth import CBProAuth
+from cbpro.order_book_manager import OrderBookManager
+from cbpro.async_websocket_client import AsyncWebsocketClient
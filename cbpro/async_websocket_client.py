@@ -0,0 +1,198 @@
+#
+# cbpro/async_websocket_client.py
+#
+# asyncio variant of WebsocketClient, running on tornado's websocket client
+
+from __future__ import print_function
+import json
+import asyncio
+from tornado.websocket import websocket_connect
+from cbpro.cbpro_auth import get_auth_headers, get_cbpro_timestamp
+
+try:
+    # orjson decodes Coinbase messages several times faster than the json module
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+class AsyncWebsocketClient(object):
+    ''' Receive messages from the Coinbase Websocket Feed in an asyncio event loop.
+
+    Unlike WebsocketClient, errors do not stop the client: the connection is
+    reopened (with exponential backoff) and the subscription sent again,
+    until stop() is called. Several clients can run in the same event loop,
+    see run_clients.
+
+    Messages are decoded by a reader coroutine and dispatched by another one.
+    The dispatcher takes all the messages received since its last call (up
+    to `batch_size`) and passes them to on_messages, which calls on_message
+    for each of them by default: override on_messages to process batches.
+    '''
+    def __init__(self, url="wss://ws-feed.pro.coinbase.com", products=None, message_type="subscribe",
+                 should_print=True, auth=False, api_key="", api_secret="", api_passphrase="", channels=None,
+                 batch_size=1000, max_queue_size=100000, reconnect_delay=1.0, max_reconnect_delay=60.0):
+        self.url = url.rstrip('/')
+        self.products = products
+        self.channels = channels
+        self.type = message_type
+        self.auth = auth
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.api_passphrase = api_passphrase
+        self.should_print = should_print
+        self.batch_size = batch_size
+        self.max_queue_size = max_queue_size
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.error = None
+        self.queue_full_count = 0
+        self.ws = None
+        self._stop = False
+        self._queue = None
+
+    async def _subscription_params(self):
+        if self.products is None:
+            self.products = ["BTC-USD"]
+        elif not isinstance(self.products, list):
+            self.products = [self.products]
+
+        sub_params = {'type': self.type, 'product_ids': self.products}
+        if self.channels is not None:
+            sub_params['channels'] = self.channels
+
+        if self.auth:
+            # The first call might synchronise the clock with a blocking request
+            timestamp = str(await asyncio.get_event_loop().run_in_executor(None, get_cbpro_timestamp))
+            message = timestamp + 'GET' + '/users/self/verify'
+            auth_headers = get_auth_headers(timestamp, message, self.api_key, self.api_secret, self.api_passphrase)
+            sub_params['signature'] = auth_headers['CB-ACCESS-SIGN']
+            sub_params['key'] = auth_headers['CB-ACCESS-KEY']
+            sub_params['passphrase'] = auth_headers['CB-ACCESS-PASSPHRASE']
+            sub_params['timestamp'] = auth_headers['CB-ACCESS-TIMESTAMP']
+
+        return sub_params
+
+    async def _connect(self):
+        self.ws = await websocket_connect(self.url, ping_interval=30)
+        await self.ws.write_message(json.dumps(await self._subscription_params()))
+
+    async def _read(self):
+        while not self._stop:
+            data = await self.ws.read_message()
+            if data is None:
+                if self._stop:
+                    return
+                raise ConnectionError("Websocket connection closed by {}".format(self.url))
+            try:
+                msg = json_loads(data)
+            except ValueError as e:
+                self.on_error(e, data)
+                continue
+            if self._queue.full():
+                self.on_queue_full()
+            await self._queue.put(msg)
+
+    async def _dispatch(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                self.on_messages(batch)
+            except Exception as e:
+                self.on_error(e)
+
+    async def run(self):
+        self._stop = False
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        dispatcher = asyncio.ensure_future(self._dispatch())
+        delay = self.reconnect_delay
+        try:
+            while not self._stop:
+                try:
+                    await self._connect()
+                    self.on_open()
+                    delay = self.reconnect_delay
+                    await self._read()
+                except Exception as e:
+                    self.on_error(e)
+                finally:
+                    if self.ws is not None:
+                        self.ws.close()
+                        self.ws = None
+                        self.on_close()
+                if not self._stop:
+                    await asyncio.sleep(delay)
+                    delay = min(2 * delay, self.max_reconnect_delay)
+            # Dispatch messages received before stop
+            while not self._queue.empty():
+                await asyncio.sleep(0)
+        finally:
+            dispatcher.cancel()
+
+    def stop(self):
+        self._stop = True
+        if self.ws is not None:
+            self.ws.close()  # wakes up the pending read
+
+    def on_open(self):
+        if self.should_print:
+            print("-- Subscribed! --\n")
+
+    def on_close(self):
+        if self.should_print:
+            print("\n-- Socket Closed --")
+
+    def on_messages(self, msgs):
+        for msg in msgs:
+            self.on_message(msg)
+
+    def on_message(self, msg):
+        if self.should_print:
+            print(msg)
+
+    def on_queue_full(self):
+        ''' Called when the dispatcher lags behind the reader: the reader then waits for the queue to drain '''
+        self.queue_full_count += 1
+
+    def on_error(self, e, data=None):
+        self.error = e
+        print('{} - data: {}'.format(e, data))
+
+
+def run_clients(*clients):
+    ''' Run several AsyncWebsocketClient in the current thread until all of them are stopped '''
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.gather(*[c.run() for c in clients]))
+
+
+if __name__ == "__main__":
+    import signal
+
+    class CountingClient(AsyncWebsocketClient):
+        def __init__(self, products, channels):
+            super(CountingClient, self).__init__(products=products, channels=channels, should_print=False)
+            self.message_count = 0
+            self.batch_count = 0
+
+        def on_messages(self, msgs):
+            self.message_count += len(msgs)
+            self.batch_count += 1
+
+    clients = [
+        CountingClient(["BTC-USD", "ETH-USD"], ["full"]),
+        CountingClient(["BTC-EUR", "ETH-EUR"], ["ticker"])
+    ]
+
+    async def report():
+        while True:
+            await asyncio.sleep(1)
+            for c in clients:
+                print(c.products, c.channels, "messages:", c.message_count, "batches:", c.batch_count)
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGINT, lambda: [c.stop() for c in clients])
+    reporter = asyncio.ensure_future(report())
+    run_clients(*clients)
+    reporter.cancel()
@@ -2,12 +2,65 @@ import hmac
 import hashlib
 import time
 import base64
+import threading
 import requests
 from requests.auth import AuthBase
 
+
+class ServerClock(object):
+    """ Time of a server served from the local clock and a measured offset.
+
+    `fetch_server_timestamp` is a callable returning the server UTC timestamp
+    in seconds. The offset is measured on first use (the server timestamp is
+    assumed to be taken half way of the round trip), then again every
+    `resync_period` seconds.
+    """
+    def __init__(self, fetch_server_timestamp, resync_period=600):
+        self._fetch_server_timestamp = fetch_server_timestamp
+        self.resync_period = resync_period
+        self.round_trip_time = None
+        self._offset = None
+        self._last_sync = None
+        self._lock = threading.Lock()
+
+    def sync(self):
+        local_before = time.time()
+        server_timestamp = float(self._fetch_server_timestamp())
+        local_after = time.time()
+        with self._lock:
+            self._offset = server_timestamp - 0.5 * (local_before + local_after)
+            self._last_sync = time.monotonic()
+            self.round_trip_time = local_after - local_before
+
+    def offset(self):
+        with self._lock:
+            needs_sync = self._offset is None or \
+                time.monotonic() - self._last_sync > self.resync_period
+        if needs_sync:
+            self.sync()
+        with self._lock:
+            return self._offset
+
+    def timestamp(self):
+        return time.time() + self.offset()
+
+
+class CBProClock(ServerClock):
+    """ Coinbase Pro server time, measured with a request to /time """
+    def __init__(self, api_url='https://api.pro.coinbase.com', resync_period=600):
+        self.url = api_url.rstrip('/')
+        self.session = requests.Session()
+        super(CBProClock, self).__init__(self._get_server_time, resync_period)
+
+    def _get_server_time(self):
+        r = self.session.get(self.url + '/time', timeout=30)
+        return r.json()["epoch"]
+
+
+_clock = CBProClock()
+
 def get_cbpro_timestamp():
-    r = requests.get('https://api.pro.coinbase.com/time')
-    return r.json()["epoch"]
+    return _clock.timestamp()
 
 class CBProAuth(AuthBase):
     # Provided by CBPro: https://docs.pro.coinbase.com/#signing-a-message
@@ -15,21 +68,27 @@ class CBProAuth(AuthBase):
         self.api_key = api_key
         self.secret_key = secret_key
         self.passphrase = passphrase
+        self.hmac_key = base64.b64decode(secret_key)
 
     def __call__(self, request):
         timestamp = str(get_cbpro_timestamp())
         message = ''.join([timestamp, request.method,
                            request.path_url, (request.body or '')])
-        request.headers.update(get_auth_headers(timestamp, message,
-                                                self.api_key,
-                                                self.secret_key,
-                                                self.passphrase))
+        request.headers.update(get_auth_headers_from_hmac_key(timestamp, message,
+                                                              self.api_key,
+                                                              self.hmac_key,
+                                                              self.passphrase))
         return request
 
 
 def get_auth_headers(timestamp, message, api_key, secret_key, passphrase):
+    return get_auth_headers_from_hmac_key(timestamp, message, api_key,
+                                          base64.b64decode(secret_key),
+                                          passphrase)
+
+
+def get_auth_headers_from_hmac_key(timestamp, message, api_key, hmac_key, passphrase):
     message = message.encode('ascii')
-    hmac_key = base64.b64decode(secret_key)
     signature = hmac.new(hmac_key, message, hashlib.sha256)
     signature_b64 = base64.b64encode(signature.digest()).decode('utf-8')
     return {
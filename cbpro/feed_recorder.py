@@ -0,0 +1,305 @@
+#
+# cbpro/feed_recorder.py
+#
+# Compact recording and replay of Coinbase Websocket Feed messages
+#
+# File format: a magic string followed by independent blocks. Each block is
+#   <B starts_with_snapshot> <d first_timestamp> <I compressed_length>
+# followed by `compressed_length` bytes of zlib compressed records, each record being
+#   <B kind> <d timestamp> <I payload_length> <payload (msgpack)>
+# where kind is MESSAGE or SNAPSHOT and timestamp the local reception time.
+# A snapshot always starts a new block, so seeking to a timestamp only reads
+# block headers until the last snapshot before it. A recording can hold several
+# products (see OrderBookManager): messages and snapshots carry their product_id.
+
+from __future__ import print_function
+import struct
+import time
+import zlib
+import msgpack
+
+from cbpro.order_book import OrderBook
+
+MAGIC = b'CBFEED1\n'
+MESSAGE = 0
+SNAPSHOT = 1
+
+BLOCK_HEADER = struct.Struct('<BdI')
+RECORD_HEADER = struct.Struct('<BdI')
+
+
+class FeedRecorder(object):
+    ''' Write websocket messages and periodic order book snapshots to a file.
+
+    Can be passed as `log_to` of an OrderBook or an OrderBookManager: each
+    book then records its messages, and a snapshot of itself every
+    `snapshot_interval` seconds.
+    '''
+    def __init__(self, path, snapshot_interval=300, block_records=5000, block_seconds=10, compression_level=6):
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self.snapshot_interval = snapshot_interval
+        self.block_records = block_records
+        self.block_seconds = block_seconds
+        self.compression_level = compression_level
+        self._records = []
+        self._block_starts_with_snapshot = False
+        self._block_timestamp = None
+        self._last_snapshot = {}  # product_id -> timestamp
+
+    def _append(self, kind, payload, timestamp):
+        if self._block_timestamp is None:
+            self._block_timestamp = timestamp
+        data = msgpack.packb(payload, use_bin_type=True)
+        self._records.append(RECORD_HEADER.pack(kind, timestamp, len(data)))
+        self._records.append(data)
+        if len(self._records) >= 2 * self.block_records or timestamp - self._block_timestamp >= self.block_seconds:
+            self.flush()
+
+    def flush(self):
+        if not self._records:
+            return
+        compressed = zlib.compress(b''.join(self._records), self.compression_level)
+        self._file.write(BLOCK_HEADER.pack(self._block_starts_with_snapshot, self._block_timestamp, len(compressed)))
+        self._file.write(compressed)
+        self._file.flush()
+        self._records = []
+        self._block_starts_with_snapshot = False
+        self._block_timestamp = None
+
+    def record(self, message, timestamp=None):
+        self._append(MESSAGE, message, timestamp or time.time())
+
+    def snapshot_due(self, product_id=None):
+        last_snapshot = self._last_snapshot.get(product_id)
+        return last_snapshot is None or time.time() - last_snapshot >= self.snapshot_interval
+
+    def record_snapshot(self, book, timestamp=None):
+        ''' Record the level 3 book of an OrderBook, in the format of get_product_order_book(level=3) '''
+        timestamp = timestamp or time.time()
+        current = book.get_current_book()
+        snapshot = {
+            'product_id': book.product_id,
+            'price_decimals': book._price_decimals,
+            'size_decimals': book._size_decimals,
+            'sequence': current['sequence'],
+            'bids': [[str(p), str(s), id] for p, s, id in current['bids']],
+            'asks': [[str(p), str(s), id] for p, s, id in current['asks']]
+        }
+        self.flush()
+        self._block_starts_with_snapshot = True
+        self._append(SNAPSHOT, snapshot, timestamp)
+        self._last_snapshot[book.product_id] = timestamp
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class FeedReader(object):
+    ''' Read records of a file written by FeedRecorder '''
+    def __init__(self, path):
+        self.path = path
+
+    def _blocks(self, f):
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a feed recording'.format(self.path))
+        while True:
+            offset = f.tell()
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                return
+            starts_with_snapshot, timestamp, length = BLOCK_HEADER.unpack(header)
+            yield offset, bool(starts_with_snapshot), timestamp, length
+            f.seek(length, 1)
+
+    def _read_first_record(self, f, length):
+        position = f.tell()
+        data = zlib.decompress(f.read(length))
+        f.seek(position)
+        _, _, payload_length = RECORD_HEADER.unpack_from(data, 0)
+        return msgpack.unpackb(data[RECORD_HEADER.size:RECORD_HEADER.size + payload_length], raw=False)
+
+    def snapshot_offset(self, timestamp, product_ids=None):
+        ''' File offset of the last block starting with a snapshot recorded at or before `timestamp`.
+
+        With `product_ids`, the first offset from which each of these products
+        has a snapshot at or before `timestamp` (products without one start at
+        their next snapshot).
+        '''
+        result = None
+        last_offsets = {}
+        with open(self.path, 'rb') as f:
+            for offset, starts_with_snapshot, block_timestamp, length in self._blocks(f):
+                if block_timestamp > timestamp:
+                    break
+                if starts_with_snapshot:
+                    result = offset
+                    if product_ids is not None:
+                        product_id = self._read_first_record(f, length).get('product_id')
+                        if product_id in product_ids:
+                            last_offsets[product_id] = offset
+        if product_ids is not None:
+            return min(last_offsets.values()) if last_offsets else None
+        return result
+
+    def records(self, offset=None):
+        ''' Yield (kind, timestamp, payload) tuples, starting from a block offset if provided '''
+        with open(self.path, 'rb') as f:
+            if offset is not None:
+                f.seek(offset)
+            else:
+                f.seek(len(MAGIC))
+            while True:
+                header = f.read(BLOCK_HEADER.size)
+                if len(header) < BLOCK_HEADER.size:
+                    return
+                _, _, length = BLOCK_HEADER.unpack(header)
+                data = zlib.decompress(f.read(length))
+                position = 0
+                while position < len(data):
+                    kind, timestamp, payload_length = RECORD_HEADER.unpack_from(data, position)
+                    position += RECORD_HEADER.size
+                    payload = msgpack.unpackb(data[position:position + payload_length], raw=False)
+                    position += payload_length
+                    yield kind, timestamp, payload
+
+
+class ReplayOrderBook(OrderBook):
+    ''' OrderBook waiting for the next recorded snapshot on sequence gaps, instead of downloading one '''
+    def _start_resync(self):
+        self._resyncing = True
+        self._buffer = []
+
+    def resume_from_snapshot(self, snapshot):
+        if snapshot.get('product_id') != self.product_id:
+            return
+        with self._lock:
+            self._resyncing = False
+            self._buffer = []
+            self.load_snapshot(snapshot)
+
+
+class FeedReplayer(object):
+    ''' Drive OrderBooks from a recording, one per product.
+
+    Replay of a product starts from one of its snapshots: the first one of the
+    file, or the last one before `start_time`. Messages are applied at maximum speed, or at
+    wall-clock pace multiplied by `speed` if provided. Books should be
+    ReplayOrderBook instances so that gaps in the recording are resolved
+    from the next recorded snapshot.
+    '''
+    def __init__(self, path):
+        self.reader = FeedReader(path)
+
+    def make_book(self, snapshot, book_class=ReplayOrderBook, **kwargs):
+        return book_class(product_id=snapshot['product_id'],
+                          price_decimals=snapshot['price_decimals'],
+                          size_decimals=snapshot['size_decimals'],
+                          **kwargs)
+
+    def replay_books(self, books=None, product_ids=None, start_time=None, end_time=None, speed=None, on_message=None):
+        ''' Replay messages into one book per product and return the dict of books by product_id.
+
+        `books` maps product ids to the books to drive, the others are created
+        from the first snapshot of their product. Only `product_ids` (the
+        products of `books` by default) are replayed if provided, all recorded
+        products otherwise. `on_message(book, message)` is called after each
+        message is applied.
+        '''
+        books = dict(books or {})
+        if product_ids is None and books:
+            product_ids = list(books.keys())
+        offset = self.reader.snapshot_offset(start_time, product_ids) if start_time is not None else None
+        started = set()
+        first_timestamp = None
+        wall_start = None
+        for kind, timestamp, payload in self.reader.records(offset):
+            if end_time is not None and timestamp > end_time:
+                break
+            product_id = payload.get('product_id')
+            if product_ids is not None and product_id not in product_ids:
+                continue
+            if kind == SNAPSHOT:
+                if product_id not in started:
+                    if product_id not in books:
+                        books[product_id] = self.make_book(payload)
+                    books[product_id].load_snapshot(payload)
+                    started.add(product_id)
+                elif books[product_id]._resyncing:
+                    books[product_id].resume_from_snapshot(payload)
+                continue
+            if product_id not in started:
+                continue
+            if speed:
+                if first_timestamp is None:
+                    first_timestamp, wall_start = timestamp, time.time()
+                delay = (timestamp - first_timestamp) / speed - (time.time() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            book = books[product_id]
+            book.on_message(payload)
+            if on_message:
+                on_message(book, payload)
+        return books
+
+    def replay(self, book=None, start_time=None, end_time=None, speed=None, on_message=None):
+        ''' Replay the messages of a single product into `book` and return the book.
+
+        If `book` is None, it is created from the first snapshot, and only the
+        product of that snapshot is replayed.
+        '''
+        if book is not None:
+            product_id = book.product_id
+        else:
+            offset = self.reader.snapshot_offset(start_time) if start_time is not None else None
+            product_id = next((payload.get('product_id') for kind, _, payload in self.reader.records(offset)
+                               if kind == SNAPSHOT), None)
+            if product_id is None:
+                return None
+        books = self.replay_books({product_id: book} if book is not None else None, [product_id],
+                                  start_time, end_time, speed, on_message)
+        return books.get(product_id)
+
+    def rebuild(self, timestamp, book=None):
+        ''' Order book as it was at `timestamp` '''
+        return self.replay(book=book, start_time=timestamp, end_time=timestamp)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Record or replay a Coinbase Pro full channel feed.')
+    commands = parser.add_subparsers(dest='action')
+    record_parser = commands.add_parser('record')
+    record_parser.add_argument('product_id')
+    record_parser.add_argument('path')
+    record_parser.add_argument('--snapshot-interval', type=int, default=300)
+    replay_parser = commands.add_parser('replay')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--speed', type=float, help='Replay at wall-clock pace multiplied by SPEED instead of maximum speed.')
+    args = parser.parse_args()
+
+    if args.action == 'record':
+        recorder = FeedRecorder(args.path, snapshot_interval=args.snapshot_interval)
+        book = OrderBook(product_id=args.product_id, log_to=recorder)
+        book.start()
+        try:
+            while True:
+                time.sleep(10)
+        except KeyboardInterrupt:
+            book.close()
+            recorder.close()
+    else:
+        counter = {'messages': 0}
+
+        def count(book, message):
+            counter['messages'] += 1
+
+        start = time.time()
+        books = FeedReplayer(args.path).replay_books(speed=args.speed, on_message=count)
+        elapsed = time.time() - start
+        print('{} messages replayed in {:.3f} seconds ({:.0f} messages/s)'.format(
+            counter['messages'], elapsed, counter['messages'] / elapsed if elapsed > 0 else 0))
+        for product_id, book in sorted(books.items()):
+            print('{} book at sequence {}'.format(product_id, book._sequence))
@@ -0,0 +1,112 @@
+#
+# cbpro/mongo_sink.py
+#
+# Buffered MongoDB writer for websocket messages
+
+from __future__ import print_function
+import time
+from threading import Thread
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class MongoSink(object):
+    ''' Insert messages into a MongoDB collection from a background thread.
+
+    put() only enqueues the message, a writer thread inserts them with
+    insert_many by batches of `batch_size` messages, or every
+    `flush_interval` seconds if fewer messages are queued. The queue holds
+    at most `max_queue_size` messages: when it is full, put() waits for the
+    writer (or drops the message if `drop_when_full` is set). close() flushes
+    the queued messages before returning.
+
+    Counters: `queued`, `inserted`, `dropped`, `errors`, `full_count` (puts
+    that found the queue full), `max_queue_length` and
+    `last_flush_seconds`, see get_metrics().
+    '''
+    def __init__(self, collection, batch_size=1000, flush_interval=1.0, max_queue_size=100000, drop_when_full=False):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop_when_full = drop_when_full
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stop = False
+        self.queued = 0
+        self.inserted = 0
+        self.dropped = 0
+        self.errors = 0
+        self.full_count = 0
+        self.max_queue_length = 0
+        self.last_flush_seconds = 0.0
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, msg):
+        if self._queue.full():
+            self.full_count += 1
+            if self.drop_when_full:
+                self.dropped += 1
+                return
+        # insert_many adds an _id field to the documents, copy the message so that the caller's dict is not modified
+        self._queue.put(dict(msg))
+        self.queued += 1
+        self.max_queue_length = max(self.max_queue_length, self._queue.qsize())
+
+    def _next_batch(self):
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, batch):
+        start = time.time()
+        try:
+            self.collection.insert_many(batch, ordered=False)
+            self.inserted += len(batch)
+        except Exception as e:
+            self.errors += 1
+            print('MongoSink: unable to insert {} messages: {}'.format(len(batch), e))
+        self.last_flush_seconds = time.time() - start
+
+    def _run(self):
+        while not self._stop:
+            batch = self._next_batch()
+            if batch:
+                self._insert(batch)
+        # Flush what is left after close()
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                break
+            self._insert(batch)
+
+    def get_metrics(self):
+        return {
+            'queued': self.queued,
+            'inserted': self.inserted,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'full_count': self.full_count,
+            'queue_length': self._queue.qsize(),
+            'max_queue_length': self.max_queue_length,
+            'last_flush_seconds': self.last_flush_seconds
+        }
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
@@ -6,23 +6,107 @@
 
 from sortedcontainers import SortedDict
 from decimal import Decimal
+from collections import namedtuple
+import threading
 import pickle
+import time
+import numpy as np
 
 from cbpro.public_client import PublicClient
 from cbpro.websocket_client import WebsocketClient
 
 
+def decimals_of(increment):
+    ''' Number of decimals of an increment string, eg. '0.01000000' -> 2 '''
+    if '.' not in increment:
+        return 0
+    return len(increment.rstrip('0').split('.')[1])
+
+
+def to_ticks(value, decimals):
+    ''' Convert a decimal string (or number) to an integer count of 10^-decimals units, without going through Decimal or float '''
+    value = str(value)
+    if 'e' in value or 'E' in value:
+        value = '{:f}'.format(Decimal(value))
+    if '.' in value:
+        integer, fraction = value.split('.')
+    else:
+        integer, fraction = value, ''
+    return int(integer + (fraction + '0' * decimals)[:decimals])
+
+
+class Order(object):
+    __slots__ = ('id', 'side', 'price', 'size')
+
+    def __init__(self, id, side, price, size):
+        self.id = id
+        self.side = side
+        self.price = price  # integer ticks
+        self.size = size  # integer lots
+
+
+class PriceLevel(object):
+    ''' Orders at a given price, in arrival order (dicts keep insertion order), with their total size '''
+    __slots__ = ('orders', 'size')
+
+    def __init__(self):
+        self.orders = {}
+        self.size = 0
+
+
+# Delay before downloading a snapshot after a failed resync, doubled on each consecutive failure
+RESYNC_MIN_DELAY = 1.0
+RESYNC_MAX_DELAY = 60.0
+
+# Aggregated top of the book: best levels first, prices and sizes as read-only float64 arrays.
+# A new snapshot object is published after each message, so consumers can keep a reference without copying or locking.
+L2Snapshot = namedtuple('L2Snapshot', ['sequence', 'bid_prices', 'bid_sizes', 'ask_prices', 'ask_sizes'])
+
+
+def read_only_array(values, scale=1.0):
+    array = np.array(values, dtype=np.float64) / scale
+    array.flags.writeable = False
+    return array
+
+
 class OrderBook(WebsocketClient):
-    def __init__(self, product_id='BTC-USD', log_to=None):
-        super(OrderBook, self).__init__(products=product_id)
+    ''' Level 3 order book.
+
+    Prices and sizes are stored as integers (counts of the product quote
+    increment and base increment decimals), price levels are kept in sorted
+    dicts, and an order id -> order index gives O(1) remove, match and change.
+    Prices and sizes are converted back to Decimal at the API boundary.
+
+    The `l2_depth` best levels of each side are also published as an
+    L2Snapshot after each message (see get_l2_snapshot).
+    '''
+    def __init__(self, product_id='BTC-USD', log_to=None, price_decimals=None, size_decimals=None, l2_depth=50, client=None,
+                 resync_lock=None):
+        super(OrderBook, self).__init__(products=[product_id])
         self._asks = SortedDict()
         self._bids = SortedDict()
-        self._client = PublicClient()
+        self._orders = {}
+        self._client = client or PublicClient()
         self._sequence = -1
         self._log_to = log_to
         if self._log_to:
-            assert hasattr(self._log_to, 'write')
+            # Either a file object receiving pickled messages, or a FeedRecorder
+            assert hasattr(self._log_to, 'write') or hasattr(self._log_to, 'record')
         self._current_ticker = None
+        self._price_decimals = price_decimals
+        self._size_decimals = size_decimals
+        self._lock = threading.RLock()
+        self._resyncing = False
+        self._buffer = []
+        self._resync_thread = None
+        self._resync_delay = 0.0
+        # Shared by books downloading snapshots from the same client, see OrderBookManager
+        self._resync_lock = resync_lock or threading.Lock()
+        self._l2_depth = l2_depth
+        self._l2_bid_limit = None
+        self._l2_ask_limit = None
+        self._l2_dirty = True
+        self._l2_snapshot = L2Snapshot(-1, read_only_array([]), read_only_array([]), read_only_array([]), read_only_array([]))
 
     @property
     def product_id(self):
@@ -30,45 +114,166 @@ class OrderBook(WebsocketClient):
         return self.products[0]
 
     def on_open(self):
-        self._sequence = -1
+        self.invalidate()
         print("-- Subscribed to OrderBook! --\n")
 
     def on_close(self):
         print("\n-- OrderBook Socket Closed! --")
 
-    def reset_book(self):
+    def _init_increments(self):
+        if self._price_decimals is not None and self._size_decimals is not None:
+            return
+        product = next(p for p in self._client.get_products() if p['id'] == self.product_id)
+        if self._price_decimals is None:
+            self._price_decimals = decimals_of(product['quote_increment'])
+        if self._size_decimals is None:
+            # Sizes are sent with 8 decimals whatever the base increment is
+            self._size_decimals = max(8, decimals_of(product.get('base_increment', '0.00000001')))
+
+    def _price_to_ticks(self, price):
+        return to_ticks(price, self._price_decimals)
+
+    def _size_to_lots(self, size):
+        return to_ticks(size, self._size_decimals)
+
+    def _ticks_to_price(self, ticks):
+        return Decimal(ticks).scaleb(-self._price_decimals)
+
+    def _lots_to_size(self, lots):
+        return Decimal(lots).scaleb(-self._size_decimals)
+
+    def _tree(self, side):
+        return self._bids if side == 'buy' else self._asks
+
+    def clear(self):
         self._asks = SortedDict()
         self._bids = SortedDict()
-        res = self._client.get_product_order_book(product_id=self.product_id, level=3)
-        for bid in res['bids']:
+        self._orders = {}
+        self._l2_bid_limit = None
+        self._l2_ask_limit = None
+        self._l2_dirty = True
+
+    def load_snapshot(self, snapshot):
+        ''' Initialize the book from a level 3 snapshot as sent by get_product_order_book(level=3) '''
+        with self._lock:
+            self._load_snapshot(snapshot)
+            self._publish_l2()
+
+    def _load_snapshot(self, snapshot):
+        self.clear()
+        for bid in snapshot['bids']:
             self.add({
                 'id': bid[2],
                 'side': 'buy',
-                'price': Decimal(bid[0]),
-                'size': Decimal(bid[1])
+                'price': bid[0],
+                'size': bid[1]
             })
-        for ask in res['asks']:
+        for ask in snapshot['asks']:
             self.add({
                 'id': ask[2],
                 'side': 'sell',
-                'price': Decimal(ask[0]),
-                'size': Decimal(ask[1])
+                'price': ask[0],
+                'size': ask[1]
             })
-        self._sequence = res['sequence']
+        self._sequence = snapshot['sequence']
+
+    def invalidate(self):
+        ''' Forget the current sequence, the book is rebuilt from a new snapshot on next message '''
+        with self._lock:
+            self._sequence = -1
+
+    def reset_book(self):
+        ''' Synchronously reload the book from a level 3 snapshot '''
+        self._init_increments()
+        res = self._client.get_product_order_book(product_id=self.product_id, level=3)
+        self.load_snapshot(res)
+
+    def _start_resync(self):
+        ''' Download a snapshot on a worker thread, live messages are buffered until it is loaded '''
+        self._resyncing = True
+        self._buffer = []
+        self._resync_thread = threading.Thread(target=self._resync)
+        self._resync_thread.daemon = True
+        self._resync_thread.start()
+
+    def _next_resync_delay(self):
+        return min(RESYNC_MAX_DELAY, max(RESYNC_MIN_DELAY, 2 * self._resync_delay))
+
+    def _resync(self):
+        # Back off after failures: live messages keep being buffered while waiting
+        with self._lock:
+            delay = self._resync_delay
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            with self._resync_lock:
+                self._init_increments()
+                snapshot = self._client.get_product_order_book(product_id=self.product_id, level=3)
+        except Exception as e:
+            snapshot = e
+
+        with self._lock:
+            try:
+                if isinstance(snapshot, Exception):
+                    raise snapshot
+                # PublicClient returns error responses (eg. rate limit exceeded) instead of raising
+                if not isinstance(snapshot, dict) or any(k not in snapshot for k in ('bids', 'asks', 'sequence')):
+                    raise RuntimeError(snapshot.get('message', snapshot) if isinstance(snapshot, dict) else snapshot)
+                self._load_snapshot(snapshot)
+            except Exception as e:
+                self._resync_delay = self._next_resync_delay()
+                print('Error: unable to download {} order book ({}), retrying on next message in {:.0f}s.'.format(
+                    self.product_id, e, self._resync_delay))
+                self.clear()
+                self._resyncing = False
+                self._buffer = []
+                self._sequence = -1
+                return
+
+            buffered = self._buffer
+            self._buffer = []
+            self._resyncing = False
+            # Messages older than the snapshot are dropped by _apply_message. If a gap is found while replaying, a new
+            # resync is started and the remaining messages go to its buffer.
+            for message in buffered:
+                self._apply_message(message)
+            # A new resync started while replaying means the snapshot was older than the buffered messages
+            self._resync_delay = self._next_resync_delay() if self._resyncing else 0.0
+            self._publish_l2()
 
     def on_message(self, message):
-        if self._log_to:
+        recorder = self._log_to if hasattr(self._log_to, 'record') else None
+        if recorder:
+            recorder.record(message)
+        elif self._log_to:
             pickle.dump(message, self._log_to)
 
+        with self._lock:
+            self._apply_message(message)
+            if self._l2_dirty:
+                self._publish_l2()
+            elif self._l2_snapshot.sequence != self._sequence:
+                self._l2_snapshot = self._l2_snapshot._replace(sequence=self._sequence)
+
+        if recorder and not self._resyncing and self._sequence != -1 and recorder.snapshot_due(self.product_id):
+            recorder.record_snapshot(self)
+
+    def _apply_message(self, message):
+        if self._resyncing:
+            self._buffer.append(message)
+            return
         sequence = message.get('sequence', -1)
         if self._sequence == -1:
-            self.reset_book()
+            self._start_resync()
+            self._buffer.append(message)
             return
         if sequence <= self._sequence:
             # ignore older messages (e.g. before order book initialization from getProductOrderBook)
             return
         elif sequence > self._sequence + 1:
             self.on_sequence_gap(self._sequence, sequence)
+            if self._resyncing:
+                self._buffer.append(message)
             return
 
         msg_type = message['type']
@@ -85,162 +290,166 @@ class OrderBook(WebsocketClient):
         self._sequence = sequence
 
     def on_sequence_gap(self, gap_start, gap_end):
-        self.reset_book()
-        print('Error: messages missing ({} - {}). Re-initializing  book at sequence.'.format(
-            gap_start, gap_end, self._sequence))
-
+        print('Error: messages missing ({} - {}). Re-initializing book from a snapshot, buffering live messages meanwhile.'.format(
+            gap_start, gap_end))
+        self._start_resync()
 
     def add(self, order):
-        order = {
-            'id': order.get('order_id') or order['id'],
-            'side': order['side'],
-            'price': Decimal(order['price']),
-            'size': Decimal(order.get('size') or order['remaining_size'])
-        }
-        if order['side'] == 'buy':
-            bids = self.get_bids(order['price'])
-            if bids is None:
-                bids = [order]
-            else:
-                bids.append(order)
-            self.set_bids(order['price'], bids)
-        else:
-            asks = self.get_asks(order['price'])
-            if asks is None:
-                asks = [order]
-            else:
-                asks.append(order)
-            self.set_asks(order['price'], asks)
+        order = Order(order.get('order_id') or order['id'],
+                      order['side'],
+                      self._price_to_ticks(order['price']),
+                      self._size_to_lots(order.get('size') or order['remaining_size']))
+        self._touch(order.side, order.price)
+        tree = self._tree(order.side)
+        level = tree.get(order.price)
+        if level is None:
+            level = PriceLevel()
+            tree[order.price] = level
+        level.orders[order.id] = order
+        level.size += order.size
+        self._orders[order.id] = order
+
+    def _remove_order(self, order):
+        self._touch(order.side, order.price)
+        tree = self._tree(order.side)
+        level = tree[order.price]
+        del level.orders[order.id]
+        level.size -= order.size
+        if not level.orders:
+            del tree[order.price]
+        del self._orders[order.id]
 
     def remove(self, order):
-        price = Decimal(order['price'])
-        if order['side'] == 'buy':
-            bids = self.get_bids(price)
-            if bids is not None:
-                bids = [o for o in bids if o['id'] != order['order_id']]
-                if len(bids) > 0:
-                    self.set_bids(price, bids)
-                else:
-                    self.remove_bids(price)
-        else:
-            asks = self.get_asks(price)
-            if asks is not None:
-                asks = [o for o in asks if o['id'] != order['order_id']]
-                if len(asks) > 0:
-                    self.set_asks(price, asks)
-                else:
-                    self.remove_asks(price)
+        order = self._orders.get(order['order_id'])
+        if order is not None:
+            self._remove_order(order)
 
     def match(self, order):
-        size = Decimal(order['size'])
-        price = Decimal(order['price'])
-
-        if order['side'] == 'buy':
-            bids = self.get_bids(price)
-            if not bids:
-                return
-            assert bids[0]['id'] == order['maker_order_id']
-            if bids[0]['size'] == size:
-                self.set_bids(price, bids[1:])
-            else:
-                bids[0]['size'] -= size
-                self.set_bids(price, bids)
+        maker = self._orders.get(order['maker_order_id'])
+        if maker is None:
+            return
+        size = self._size_to_lots(order['size'])
+        if size >= maker.size:
+            self._remove_order(maker)
         else:
-            asks = self.get_asks(price)
-            if not asks:
-                return
-            assert asks[0]['id'] == order['maker_order_id']
-            if asks[0]['size'] == size:
-                self.set_asks(price, asks[1:])
-            else:
-                asks[0]['size'] -= size
-                self.set_asks(price, asks)
+            self._touch(maker.side, maker.price)
+            maker.size -= size
+            self._tree(maker.side)[maker.price].size -= size
 
     def change(self, order):
         try:
-            new_size = Decimal(order['new_size'])
+            new_size = self._size_to_lots(order['new_size'])
         except KeyError:
             return
 
-        try:
-            price = Decimal(order['price'])
-        except KeyError:
+        if 'price' not in order:
             return
 
-        if order['side'] == 'buy':
-            bids = self.get_bids(price)
-            if bids is None or not any(o['id'] == order['order_id'] for o in bids):
-                return
-            index = [b['id'] for b in bids].index(order['order_id'])
-            bids[index]['size'] = new_size
-            self.set_bids(price, bids)
-        else:
-            asks = self.get_asks(price)
-            if asks is None or not any(o['id'] == order['order_id'] for o in asks):
-                return
-            index = [a['id'] for a in asks].index(order['order_id'])
-            asks[index]['size'] = new_size
-            self.set_asks(price, asks)
-
-        tree = self._asks if order['side'] == 'sell' else self._bids
-        node = tree.get(price)
-
-        if node is None or not any(o['id'] == order['order_id'] for o in node):
+        existing = self._orders.get(order['order_id'])
+        if existing is None:
             return
+        self._touch(existing.side, existing.price)
+        self._tree(existing.side)[existing.price].size += new_size - existing.size
+        existing.size = new_size
 
     def get_current_ticker(self):
         return self._current_ticker
 
+    def _level_to_list(self, level):
+        return [
+            {
+                'id': o.id,
+                'side': o.side,
+                'price': self._ticks_to_price(o.price),
+                'size': self._lots_to_size(o.size)
+            } for o in list(level.orders.values())
+        ]
+
+    def _touch(self, side, price):
+        ''' Mark the L2 snapshot as outdated if the price is within its levels (or if a side has fewer levels than its depth) '''
+        if side == 'buy':
+            if self._l2_bid_limit is None or price >= self._l2_bid_limit:
+                self._l2_dirty = True
+        else:
+            if self._l2_ask_limit is None or price <= self._l2_ask_limit:
+                self._l2_dirty = True
+
+    def _publish_l2(self):
+        bid_ticks = list(self._bids.islice(start=max(0, len(self._bids) - self._l2_depth), reverse=True))
+        ask_ticks = list(self._asks.islice(stop=self._l2_depth))
+        self._l2_bid_limit = bid_ticks[-1] if len(bid_ticks) == self._l2_depth else None
+        self._l2_ask_limit = ask_ticks[-1] if len(ask_ticks) == self._l2_depth else None
+        price_scale = 10.0 ** self._price_decimals if self._price_decimals is not None else 1.0
+        size_scale = 10.0 ** self._size_decimals if self._size_decimals is not None else 1.0
+        self._l2_snapshot = L2Snapshot(
+            self._sequence,
+            read_only_array(bid_ticks, price_scale),
+            read_only_array([self._bids[t].size for t in bid_ticks], size_scale),
+            read_only_array(ask_ticks, price_scale),
+            read_only_array([self._asks[t].size for t in ask_ticks], size_scale))
+        self._l2_dirty = False
+
+    def get_l2_snapshot(self):
+        ''' Aggregated `l2_depth` best levels of each side, as of the returned sequence. Never blocks the feed thread. '''
+        return self._l2_snapshot
+
     def get_current_book(self):
-        result = {
-            'sequence': self._sequence,
-            'asks': [],
-            'bids': [],
+        ''' Full level 3 book, consistent with the returned sequence.
+
+        The feed thread is only blocked while integer order records are
+        copied, the conversion to Decimal is done after releasing the lock.
+        '''
+        with self._lock:
+            sequence = self._sequence
+            asks = [(o.price, o.size, o.id) for level in self._asks.values() for o in level.orders.values()]
+            bids = [(o.price, o.size, o.id) for level in self._bids.values() for o in level.orders.values()]
+        return {
+            'sequence': sequence,
+            'asks': [[self._ticks_to_price(p), self._lots_to_size(s), id] for p, s, id in asks],
+            'bids': [[self._ticks_to_price(p), self._lots_to_size(s), id] for p, s, id in bids],
         }
-        for ask in self._asks:
-            try:
-                # There can be a race condition here, where a price point is removed
-                # between these two ops
-                this_ask = self._asks[ask]
-            except KeyError:
-                continue
-            for order in this_ask:
-                result['asks'].append([order['price'], order['size'], order['id']])
-        for bid in self._bids:
-            try:
-                # There can be a race condition here, where a price point is removed
-                # between these two ops
-                this_bid = self._bids[bid]
-            except KeyError:
-                continue
-
-            for order in this_bid:
-                result['bids'].append([order['price'], order['size'], order['id']])
-        return result
 
     def get_ask(self):
-        return self._asks.peekitem(0)[0]
+        return self._ticks_to_price(self._asks.peekitem(0)[0])
 
     def get_asks(self, price):
-        return self._asks.get(price)
+        level = self._asks.get(self._price_to_ticks(price))
+        return self._level_to_list(level) if level is not None else None
+
+    def get_ask_depth(self, price):
+        level = self._asks.get(self._price_to_ticks(price))
+        return self._lots_to_size(level.size) if level is not None else Decimal(0)
 
     def remove_asks(self, price):
-        del self._asks[price]
+        for order in list(self._asks[self._price_to_ticks(price)].orders.values()):
+            self._remove_order(order)
 
     def set_asks(self, price, asks):
-        self._asks[price] = asks
+        if self._price_to_ticks(price) in self._asks:
+            self.remove_asks(price)
+        for order in asks:
+            self.add(dict(order, side='sell', price=price))
 
     def get_bid(self):
-        return self._bids.peekitem(-1)[0]
+        return self._ticks_to_price(self._bids.peekitem(-1)[0])
 
     def get_bids(self, price):
-        return self._bids.get(price)
+        level = self._bids.get(self._price_to_ticks(price))
+        return self._level_to_list(level) if level is not None else None
+
+    def get_bid_depth(self, price):
+        level = self._bids.get(self._price_to_ticks(price))
+        return self._lots_to_size(level.size) if level is not None else Decimal(0)
 
     def remove_bids(self, price):
-        del self._bids[price]
+        for order in list(self._bids[self._price_to_ticks(price)].orders.values()):
+            self._remove_order(order)
 
     def set_bids(self, price, bids):
-        self._bids[price] = bids
+        if self._price_to_ticks(price) in self._bids:
+            self.remove_bids(price)
+        for order in bids:
+            self.add(dict(order, side='buy', price=price))
 
 
 if __name__ == '__main__':
@@ -266,11 +475,9 @@ if __name__ == '__main__':
 
             # Calculate newest bid-ask spread
             bid = self.get_bid()
-            bids = self.get_bids(bid)
-            bid_depth = sum([b['size'] for b in bids])
+            bid_depth = self.get_bid_depth(bid)
             ask = self.get_ask()
-            asks = self.get_asks(ask)
-            ask_depth = sum([a['size'] for a in asks])
+            ask_depth = self.get_ask_depth(ask)
 
             if self._bid == bid and self._ask == ask and self._bid_depth == bid_depth and self._ask_depth == ask_depth:
                 # If there are no changes to the bid-ask spread since the last update, no need to print
@@ -0,0 +1,88 @@
+#
+# cbpro/order_book_manager.py
+#
+# Several live order books updated from a single Coinbase Websocket Feed
+
+import threading
+
+from cbpro.public_client import PublicClient
+from cbpro.rate_limit import TokenBucket, RateLimitedSession
+from cbpro.websocket_client import WebsocketClient
+from cbpro.order_book import OrderBook, decimals_of
+
+
+class OrderBookManager(WebsocketClient):
+    ''' Maintain one OrderBook per product over a single websocket connection.
+
+    Messages are routed to the book of their `product_id`. The books are
+    never started: they only process the messages forwarded by the manager,
+    so a sequence gap only resets the book of the product it happened on.
+    Books share the REST client of the manager, and product increments are
+    downloaded once for all of them. Unless a client is given, its session is
+    rate limited to the public budget of Coinbase Pro (3 requests per second,
+    bursts of 6), and books download their snapshots one at a time so that
+    resyncing after a reconnection does not exceed it.
+    '''
+    def __init__(self, product_ids, log_to=None, l2_depth=50, book_class=OrderBook, client=None):
+        super(OrderBookManager, self).__init__(products=list(product_ids))
+        if client is None:
+            client = PublicClient()
+            client.session = RateLimitedSession(TokenBucket(6, 3))
+        self._client = client
+        self._resync_lock = threading.Lock()
+        products = {p['id']: p for p in self._client.get_products()}
+        self._books = {}
+        for product_id in self.products:
+            product = products[product_id]
+            self._books[product_id] = book_class(
+                product_id=product_id,
+                log_to=log_to,
+                price_decimals=decimals_of(product['quote_increment']),
+                size_decimals=max(8, decimals_of(product.get('base_increment', '0.00000001'))),
+                l2_depth=l2_depth,
+                client=self._client,
+                resync_lock=self._resync_lock)
+
+    @property
+    def product_ids(self):
+        return list(self._books.keys())
+
+    def get_book(self, product_id):
+        return self._books[product_id]
+
+    def on_open(self):
+        # Books are rebuilt from a new snapshot after each (re)connection
+        for book in self._books.values():
+            book.invalidate()
+        print("-- Subscribed to OrderBookManager ({} products)! --\n".format(len(self._books)))
+
+    def on_close(self):
+        print("\n-- OrderBookManager Socket Closed! --")
+
+    def on_message(self, message):
+        book = self._books.get(message.get('product_id'))
+        if book is not None:
+            book.on_message(message)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    manager = OrderBookManager(['BTC-USD', 'ETH-USD', 'LTC-USD'])
+    manager.start()
+    try:
+        while True:
+            time.sleep(10)
+            for product_id in manager.product_ids:
+                l2 = manager.get_book(product_id).get_l2_snapshot()
+                if len(l2.bid_prices) > 0 and len(l2.ask_prices) > 0:
+                    print('{} bid: {:.3f} @ {:.2f}\task: {:.3f} @ {:.2f}'.format(
+                        product_id, l2.bid_sizes[0], l2.bid_prices[0], l2.ask_sizes[0], l2.ask_prices[0]))
+    except KeyboardInterrupt:
+        manager.close()
+
+    if manager.error:
+        sys.exit(1)
+    else:
+        sys.exit(0)
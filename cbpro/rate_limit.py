@@ -0,0 +1,66 @@
+#
+# cbpro/rate_limit.py
+#
+# Token buckets throttling REST requests
+
+import time
+import threading
+
+import requests
+
+
+class TokenBucket(object):
+    ''' Request budget: each request consumes a weight and tokens are refilled
+    continuously up to the capacity of the bucket.
+
+    A bucket is shared by every thread talking to the same API.
+    '''
+    def __init__(self, capacity, refill_per_second):
+        self._capacity = float(capacity)
+        self._refill_per_second = float(refill_per_second)
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._refill_per_second)
+        self._last_refill = now
+
+    def acquire(self, weight=1):
+        weight = min(float(weight), self._capacity)  # a request heavier than the bucket would wait forever
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= weight:
+                    self._tokens -= weight
+                    return
+                wait_seconds = (weight - self._tokens) / self._refill_per_second
+            time.sleep(wait_seconds)
+
+    def drain(self, seconds):
+        ''' Called when the API tells us we are over the limit: empty the bucket so
+        that no token is available before `seconds` have elapsed '''
+        with self._lock:
+            self._refill()
+            self._tokens = -seconds * self._refill_per_second
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+class RateLimitedSession(requests.Session):
+    ''' A requests session consuming one token of a bucket for each request.
+
+    Allows to rate limit clients that expose their session (eg. PublicClient).
+    '''
+    def __init__(self, bucket, weight=1):
+        super(RateLimitedSession, self).__init__()
+        self._bucket = bucket
+        self._weight = weight
+
+    def request(self, method, url, *args, **kwargs):
+        self._bucket.acquire(self._weight)
+        return super(RateLimitedSession, self).request(method, url, *args, **kwargs)
@@ -14,7 +14,8 @@ import time
 from threading import Thread
 from websocket import create_connection, WebSocketConnectionClosedException
 from pymongo import MongoClient
-from cbpro.cbpro_auth import get_auth_headers
+from cbpro.cbpro_auth import get_auth_headers, get_cbpro_timestamp
+from cbpro.mongo_sink import MongoSink
 
 
 class WebsocketClient(object):
@@ -34,14 +35,21 @@ class WebsocketClient(object):
         self.api_passphrase = api_passphrase
         self.should_print = should_print
         self.mongo_collection = mongo_collection
+        self.mongo_sink = None
 
     def start(self):
         def _go():
-            self._connect()
+            try:
+                self._connect()
+            except Exception as e:
+                self.on_error(e)
+                return
             self._listen()
             self._disconnect()
 
         self.stop = False
+        if self.mongo_collection is not None and self.mongo_sink is None:
+            self.mongo_sink = MongoSink(self.mongo_collection)
         self.on_open()
         self.thread = Thread(target=_go)
         self.keepalive = Thread(target=self._keepalive)
@@ -62,7 +70,7 @@ class WebsocketClient(object):
             sub_params = {'type': 'subscribe', 'product_ids': self.products, 'channels': self.channels}
 
         if self.auth:
-            timestamp = str(time.time())
+            timestamp = str(get_cbpro_timestamp())
             message = timestamp + 'GET' + '/users/self/verify'
             auth_headers = get_auth_headers(timestamp, message, self.api_key, self.api_secret, self.api_passphrase)
             sub_params['signature'] = auth_headers['CB-ACCESS-SIGN']
@@ -99,7 +107,8 @@ class WebsocketClient(object):
         except WebSocketConnectionClosedException as e:
             pass
         finally:
-            self.keepalive.join()
+            if self.keepalive.is_alive():  # not started if the connection failed
+                self.keepalive.join()
 
         self.on_close()
 
@@ -107,6 +116,13 @@ class WebsocketClient(object):
         self.stop = True   # will only disconnect after next msg recv
         self._disconnect() # force disconnect so threads can join
         self.thread.join()
+        if self.mongo_sink:
+            self.mongo_sink.close() # flush buffered messages
+            self.mongo_sink = None
+
+    def is_running(self):
+        ''' False once the client is closed or stopped by an error (connection failures included), or if the feed thread died '''
+        return not self.stop and self.thread is not None and self.thread.is_alive()
 
     def on_open(self):
         if self.should_print:
@@ -119,8 +135,8 @@ class WebsocketClient(object):
     def on_message(self, msg):
         if self.should_print:
             print(msg)
-        if self.mongo_collection:  # dump JSON to given mongo collection
-            self.mongo_collection.insert_one(msg)
+        if self.mongo_sink:  # dump JSON to given mongo collection, by batches from a background thread
+            self.mongo_sink.put(msg)
 
     def on_error(self, e, data=None):
         self.error = e
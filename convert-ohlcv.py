@@ -0,0 +1,32 @@
+import argparse
+from ohlcv_storage import make_ohlcv_storage, storage_formats
+
+def parse_cli_args():
+    parser = argparse.ArgumentParser(description='Convert an archive of OHLCV files from a storage format to another.')
+
+    parser.add_argument("input_folder", type=str, help="Path to the folder containing OHLCV files to convert.")
+    parser.add_argument("output_folder", type=str, help="Path to the folder where converted OHLCV files should be stored.")
+    parser.add_argument("--from", dest="from_format", choices=storage_formats.keys(), default="csv", help="Format of input files. Default to csv.")
+    parser.add_argument("--to", dest="to_format", choices=storage_formats.keys(), default="parquet", help="Format of output files. Default to parquet.")
+
+    return parser.parse_args()
+
+def main():
+    args = parse_cli_args()
+
+    input_storage = make_ohlcv_storage(args.from_format, args.input_folder)
+    output_storage = make_ohlcv_storage(args.to_format, args.output_folder)
+
+    for exchange, instrument, timeframe in input_storage.list_series():
+        df = input_storage.load(exchange, instrument, timeframe)
+
+        # Only append candles that are not already in the output, so that the conversion can be run again to update it
+        last_close_timestamp = output_storage.last_close_timestamp(exchange, instrument, timeframe)
+        if last_close_timestamp != None:
+            df = df[df.index > last_close_timestamp]
+
+        print("-- Converting {} candles of {} {} {} to {}".format(len(df), exchange, instrument, timeframe, output_storage.path(exchange, instrument, timeframe)))
+        output_storage.append(exchange, instrument, timeframe, df)
+
+if __name__ == "__main__":
+    main()
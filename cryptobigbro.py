@@ -1,8 +1,13 @@
 import argparse, os, time, json
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from utils import ensure_mkdir, origin_of_time, timedelta, compute_end_timestamp, string_list_arg, to_comma_separated_string
+from ohlcv_storage import make_ohlcv_storage, storage_formats
+from candle_aggregator import CandleAggregator, CandleAggregatorClient
+from resample import can_resample, resample_series_list
 from exchanges import make_bitmex_exchange, make_binance_exchange, make_coinbasepro_exchange
+from exchanges.pagination import iterate_ohlcv_pages
 import pprint
 
 def parse_cli_args():
@@ -19,7 +24,13 @@ def parse_cli_args():
         help='Name of instruments to fetch data, eg. XBTUSD, ETHBTC, etc. Depends on the exchange. If not provided, all instruments provided by the exchange will be fetched.'
     )
     fetch_ohlcv_parser.add_argument(
-        'folder', help='Path to the folder where OHLCV csv files should be stored.'
+        'folder', help='Path to the folder where OHLCV files should be stored.'
+    )
+    fetch_ohlcv_parser.add_argument(
+        '--format',
+        choices=storage_formats.keys(),
+        default="csv",
+        help='Storage format of OHLCV files: csv (one file per instrument/timeframe) or parquet (one folder per instrument/timeframe, one file per month). Default to csv.'
     )
     fetch_ohlcv_parser.add_argument(
         '--timeframes',
@@ -29,8 +40,19 @@ def parse_cli_args():
     fetch_ohlcv_parser.add_argument(
         '--delay',
         type=int,
-        default=1000,
-        help='Time to wait in milliseconds between requests. Default to 1000.'
+        default=0,
+        help='Additional time to wait in milliseconds between two requests of the same instrument/timeframe. Requests are already throttled according to the rate limits of the exchange. Default to 0.'
+    )
+    fetch_ohlcv_parser.add_argument(
+        '--jobs',
+        type=int,
+        default=8,
+        help='Number of instrument/timeframe pairs fetched concurrently. Default to 8.'
+    )
+    fetch_ohlcv_parser.add_argument(
+        '--resample-from',
+        metavar='BASE_TIMEFRAME',
+        help='Only fetch BASE_TIMEFRAME (eg. 1m) from the exchange and build the other timeframes from it locally, when they are multiples of it.'
     )
 
     commands.add_parser("list-instruments") \
@@ -73,8 +95,219 @@ def parse_cli_args():
 
     list_exchanges_parser = commands.add_parser("list-exchanges")
 
+    sweep_parser = commands.add_parser("sweep")
+    sweep_parser.add_argument(
+        'exchanges',
+        type=string_list_arg,
+        help='A comma separated list of exchanges to fetch, eg. bitmex,binance,coinbasepro. All their instruments are fetched.'
+    )
+    sweep_parser.add_argument(
+        'folder', help='Path to the folder where OHLCV files should be stored.'
+    )
+    sweep_parser.add_argument(
+        '--timeframes',
+        type=string_list_arg,
+        help='A comma separated list of timeframes. Timeframes not provided by an exchange are ignored for this exchange. If not provided, all timeframes provided by each exchange will be fetched.'
+    )
+    sweep_parser.add_argument(
+        '--format',
+        choices=storage_formats.keys(),
+        default="csv",
+        help='Storage format of OHLCV files. Default to csv.'
+    )
+    sweep_parser.add_argument(
+        '--delay',
+        type=int,
+        default=0,
+        help='Additional time to wait in milliseconds between two requests of the same instrument/timeframe. Default to 0.'
+    )
+    sweep_parser.add_argument(
+        '--jobs',
+        type=int,
+        default=16,
+        help='Number of instrument/timeframe pairs fetched concurrently, all exchanges included. Default to 16.'
+    )
+    sweep_parser.add_argument(
+        '--resample-from',
+        metavar='BASE_TIMEFRAME',
+        help='Only fetch BASE_TIMEFRAME (eg. 1m) from the exchange and build the other timeframes from it locally, when they are multiples of it.'
+    )
+    sweep_parser.add_argument(
+        '--per-instrument-folders',
+        action='store_true',
+        help='Store the files of each instrument in its own sub-folder EXCHANGE-INSTRUMENT, with an info.json file written on creation.'
+    )
+    sweep_parser.add_argument(
+        '--updated-list',
+        help='Path to a file receiving the list of updated files (or sub-folders with --per-instrument-folders), one per line.'
+    )
+    sweep_parser.add_argument(
+        '--created-list',
+        help='Path to a file receiving the list of sub-folders created by this run with --per-instrument-folders, one per line.'
+    )
+
+    aggregate_trades_parser = commands.add_parser("aggregate-trades")
+    aggregate_trades_parser.add_argument(
+        'exchange', help='Name of the exchange, only coinbasepro provides a trade stream for now.'
+    )
+    aggregate_trades_parser.add_argument(
+        'folder', help='Path to the folder where OHLCV files should be stored.'
+    )
+    aggregate_trades_parser.add_argument(
+        '--instruments',
+        type=string_list_arg,
+        required=True,
+        help='Name of instruments to aggregate, eg. BTC-EUR,ETH-EUR.'
+    )
+    aggregate_trades_parser.add_argument(
+        '--timeframes',
+        type=string_list_arg,
+        default=["1m", "5m", "15m", "1h", "6h", "1d"],
+        help='A comma separated list of timeframes built from 1m candles. Default to 1m,5m,15m,1h,6h,1d.'
+    )
+    aggregate_trades_parser.add_argument(
+        '--format',
+        choices=storage_formats.keys(),
+        default="csv",
+        help='Storage format of OHLCV files. Default to csv.'
+    )
+
     return parser.parse_args()
 
+def fetch_ohlcv_job(exchange, exchange_name, storage, instrument, tf, exchange_time, delay, resampled_timeframes=[]):
+    # Fetch candles of tf, then extend the series of resampled_timeframes from them.
+    # Returns the number of fetched and resampled candles.
+    candle_count = fetch_candles(exchange, exchange_name, storage, instrument, tf, exchange_time, delay)
+    until = int(compute_end_timestamp(exchange_time, tf).timestamp())
+    counts = resample_series_list(storage, exchange_name, instrument, tf, resampled_timeframes, until)
+    for resampled_tf, count in zip(resampled_timeframes, counts):
+        if count > 0:
+            print("[{}-{}] -- {} candles resampled from {}.".format(instrument, resampled_tf, count, tf))
+        candle_count += count
+    return candle_count
+
+def fetch_candles(exchange, exchange_name, storage, instrument, tf, exchange_time, delay):
+    prefix = "[{}-{}]".format(instrument, tf)
+
+    since = origin_of_time
+    last_close_timestamp = storage.last_close_timestamp(exchange_name, instrument, tf)
+    if last_close_timestamp != None:
+        since = datetime.fromtimestamp(last_close_timestamp, timezone.utc)
+        print("{} -- Existing history in {} ends at {}.".format(prefix, storage.path(exchange_name, instrument, tf), since))
+
+    next_open_date = compute_end_timestamp(since, tf) + timedelta('1s')
+    if exchange_time < next_open_date:
+        print("{} -- Exchange time is {} and next candle time is {}, no request needed.".format(prefix, exchange_time, next_open_date))
+        return 0
+
+    print("{} -- Fetching candles since {}".format(prefix, since))
+    candle_count = 0
+    # Pages up to the last closed candle, the next page is requested while the current one is written
+    end = compute_end_timestamp(exchange.get_utc_time(), tf)
+    pages = iterate_ohlcv_pages(lambda s: exchange.fetch_ohlcv(tf, s, instrument), since, end, delay / 1000.0)
+    for df in pages:
+        print("{} -- {} candles received, from {} to {}.".format(prefix, len(df),
+            datetime.fromtimestamp(df.index.values[0], timezone.utc), datetime.fromtimestamp(df.close_timestamp_utc.values[-1], timezone.utc)))
+        storage.append(exchange_name, instrument, tf, df)
+        candle_count += len(df)
+
+    print("{} -- {} candles received, work is done.".format(prefix, candle_count))
+    return candle_count
+
+def run_fetch_ohlcv_jobs(jobs, max_workers):
+    # Each job is a tuple of arguments of fetch_ohlcv_job.
+    # Requests are throttled by the rate limiter of each exchange, so the pool only bounds the number of requests in flight.
+    # Returns the number of candles fetched by each job, None for jobs that failed.
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [ executor.submit(fetch_ohlcv_job, *job) for job in jobs ]
+        for job, future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                exchange_name, instrument, tf = job[1], job[3], job[4]
+                print("[ERROR] Unable to fetch data of exchange {} for instrument {} and timeframe {}: {}".format(exchange_name, instrument, tf, e))
+                results.append(None)
+    return results
+
+def split_resampled_timeframes(timeframes, base_timeframe):
+    # Returns the list of timeframes to fetch from the exchange and the list of timeframes to build from base_timeframe
+    if not base_timeframe:
+        return timeframes, []
+    resampled = [ tf for tf in timeframes if can_resample(base_timeframe, tf) ]
+    return [ base_timeframe ] + [ tf for tf in timeframes if tf != base_timeframe and not tf in resampled ], resampled
+
+def get_instrument_info_dict(exchange, instrument):
+    instrument_info = exchange.get_instrument_info(instrument)
+    d = {
+        "instrument": instrument_info.__dict__
+    }
+    if exchange.name() != "bitmex":
+        d["base_asset"] = exchange.get_asset_info(instrument_info.base_asset).__dict__
+        d["quote_asset"] = exchange.get_asset_info(instrument_info.quote_asset).__dict__
+    return d
+
+def write_lines(path, lines):
+    with open(path, "w") as f:
+        for l in lines:
+            f.write(l + "\n")
+
+def sweep(args, exchange_factories):
+    # Fetch all instruments of several exchanges in a single process: exchange metadata is loaded once per exchange,
+    # and jobs of all exchanges share the same pool since each exchange has its own rate limiter
+    ensure_mkdir(args.folder)
+    shared_storage = None if args.per_instrument_folders else make_ohlcv_storage(args.format, args.folder)
+
+    jobs = []
+    created_folders = []
+    for exchange_name in args.exchanges:
+        if not exchange_name in exchange_factories:
+            print("[ERROR] Unsupported exchange {}".format(exchange_name))
+            continue
+        exchange = exchange_factories[exchange_name]()
+        exchange_timeframes = exchange.get_timeframes()
+        timeframes = [ tf for tf in args.timeframes if tf in exchange_timeframes ] if args.timeframes else exchange_timeframes
+        if args.resample_from and not args.resample_from in exchange_timeframes:
+            print("[ERROR] Unsupported timeframe {} for exchange {}.".format(args.resample_from, exchange_name))
+            continue
+        timeframes, resampled_timeframes = split_resampled_timeframes(timeframes, args.resample_from)
+        exchange_time = exchange.get_utc_time()
+
+        print("Exchange {} at time {}.".format(exchange_name, exchange_time))
+
+        for instrument in exchange.get_instruments():
+            if args.per_instrument_folders:
+                folder = os.path.join(args.folder, exchange_name + "-" + instrument)
+                if not os.path.exists(folder):
+                    ensure_mkdir(folder)
+                    with open(os.path.join(folder, "info.json"), "w") as f:
+                        json.dump(get_instrument_info_dict(exchange, instrument), f, indent=4)
+                    created_folders.append(folder)
+                storage = make_ohlcv_storage(args.format, folder)
+            else:
+                storage = shared_storage
+            for tf in timeframes:
+                jobs.append((exchange, exchange_name, storage, instrument, tf, exchange_time, args.delay,
+                    resampled_timeframes if tf == args.resample_from else []))
+
+    results = run_fetch_ohlcv_jobs(jobs, args.jobs)
+
+    updated = []
+    for job, candle_count in zip(jobs, results):
+        if candle_count:
+            exchange_name, storage, instrument = job[1], job[2], job[3]
+            for tf in [ job[4] ] + job[7]:
+                path = storage.folder if args.per_instrument_folders else storage.path(exchange_name, instrument, tf)
+                if not path in updated:
+                    updated.append(path)
+
+    print("{} jobs done, {} failed, {} {} updated.".format(len(jobs), results.count(None), len(updated), "folders" if args.per_instrument_folders else "series"))
+
+    if args.updated_list:
+        write_lines(args.updated_list, updated)
+    if args.created_list:
+        write_lines(args.created_list, created_folders)
+
 def main():
     # pp = pprint.PrettyPrinter(indent=4)
 
@@ -90,6 +323,10 @@ def main():
         print(to_comma_separated_string(exchanges.keys()))
         exit(0)
 
+    if args.action == "sweep":
+        sweep(args, exchanges)
+        exit(0)
+
     if args.exchange in exchanges.keys():
         exchange = exchanges[args.exchange]()
     else:
@@ -117,7 +354,7 @@ def main():
         exit(0)
 
     if args.action == "tickers":
-        print(exchange.get_tickers())
+        print(exchange.get_tickers().to_string())
         exit(0)
 
     if args.action == "instrument-info":
@@ -125,19 +362,48 @@ def main():
         if not args.instrument in exchange_instruments:
             print("[ERROR] Unsupported instrument {} for exchange {}.".format(args.instrument, args.exchange))
             exit(-1)
-        instrument_info = exchange.get_instrument_info(args.instrument)
-        d = {
-            "instrument": instrument_info.__dict__
-        }
-        if args.exchange != "bitmex":
-            d["base_asset"] = exchange.get_asset_info(instrument_info.base_asset).__dict__
-            d["quote_asset"] = exchange.get_asset_info(instrument_info.quote_asset).__dict__
-        print(json.dumps(d, indent=4))
+        print(json.dumps(get_instrument_info_dict(exchange, args.instrument), indent=4))
+        exit(0)
+
+    if args.action == "aggregate-trades":
+        if args.exchange != "coinbasepro":
+            print("[ERROR] Trade aggregation is not supported for exchange {}.".format(args.exchange))
+            exit(-1)
+        exchange_instruments = exchange.get_instruments()
+        for instrument in args.instruments:
+            if not instrument in exchange_instruments:
+                print("[ERROR] Unsupported instrument {} for exchange {}.".format(instrument, args.exchange))
+                exit(-1)
+        storage = make_ohlcv_storage(args.format, args.folder)
+        exchange_timeframes = exchange.get_timeframes()
+
+        def backfill(instrument, tf):
+            # Candles missed since the last stored one: from the REST API, or resampled from the stored 1m candles
+            exchange_time = exchange.get_utc_time()
+            if tf in exchange_timeframes:
+                fetch_candles(exchange, args.exchange, storage, instrument, tf, exchange_time, 0)
+            elif can_resample("1m", tf):
+                resample_series_list(storage, args.exchange, instrument, "1m", [ tf ], int(compute_end_timestamp(exchange_time, tf).timestamp()))
+
+        aggregator = CandleAggregator(storage, args.exchange, args.timeframes,
+            on_candle=lambda instrument, tf, bar: print("[{}-{}] Closed candle {}".format(instrument, tf, datetime.fromtimestamp(bar.open_timestamp, timezone.utc))),
+            backfill=backfill)
+        client = CandleAggregatorClient(aggregator, args.instruments, clock=exchange.get_utc_timestamp)
+        client.start()
+        try:
+            while True:
+                time.sleep(10)
+                if client.stop:
+                    print("[ERROR] Websocket connection lost ({}), reconnecting.".format(client.error))
+                    client.thread.join()
+                    client.start()
+        except KeyboardInterrupt:
+            client.close()
         exit(0)
 
     assert(args.action == "fetch-ohlcv")
 
-    ensure_mkdir(args.folder)
+    storage = make_ohlcv_storage(args.format, args.folder)
 
     timeframes = args.timeframes if args.timeframes else exchange.get_timeframes()
     instruments = args.instruments if args.instruments else exchange.get_instruments()
@@ -148,47 +414,26 @@ def main():
 
     print("Exchange {} at time {}.".format(args.exchange, exchange_time))
 
+    if args.resample_from and not args.resample_from in exchange_timeframes:
+        print("[ERROR] Unsupported timeframe {} for exchange {}.".format(args.resample_from, args.exchange))
+        exit(-1)
+    timeframes, resampled_timeframes = split_resampled_timeframes(timeframes, args.resample_from)
+
+    jobs = []
     for instrument in instruments:
         if not instrument in exchange_instruments:
             print("[ERROR] Unsupported instrument {} for exchange {}.".format(instrument, args.exchange))
             continue
-
-        print("-- Fetching data for instrument {}.".format(instrument))
-
         for tf in timeframes:
             if not tf in exchange_timeframes:
                 print("[ERROR] Unsupported timeframe {} for exchange {}.".format(tf, args.exchange))
                 continue
+            jobs.append((instrument, tf))
 
-            print("\t-- Fetching data for timeframe {}.".format(tf))
-
-            path_to_csv_file = os.path.join(args.folder, args.exchange + "-" + instrument + "-" + tf + ".csv")
-
-            since = origin_of_time
-            if (os.path.exists(path_to_csv_file)):
-                print("\t\t-- Loading existing history from file {} to get next timestamp.".format(path_to_csv_file))
-                df = pd.read_csv(path_to_csv_file, index_col='open_timestamp_utc')
-                since = datetime.fromtimestamp(df.close_timestamp_utc.values[-1], timezone.utc)
-
-            next_open_date = compute_end_timestamp(since, tf) + timedelta('1s')
-            if exchange_time < next_open_date:
-                print("\t\t-- Exchange time is {} and next candle time is {}, no request needed.".format(exchange_time, since + td))
-                continue 
-
-            while True:
-                print("\t\t-- Fetching candles since {}".format(since))
-                df = exchange.fetch_ohlcv(timeframe=tf, since=since, instrument=instrument)
-                
-                if df.empty:
-                    print("\t\t-- No candles received for timeframe {}, work is done.".format(tf))
-                    break
-                else:
-                    print("\t\t-- {} candles received.".format(len(df)))
-
-                df.to_csv(path_to_csv_file, index_label='open_timestamp_utc', mode='a', header=not os.path.exists(path_to_csv_file))
-                since = datetime.fromtimestamp(df.close_timestamp_utc.values[-1], timezone.utc)
-
-                time.sleep(args.delay / 1000.0)  # ensure we don't flood exchange API with requests
+    run_fetch_ohlcv_jobs([
+        (exchange, args.exchange, storage, instrument, tf, exchange_time, args.delay, resampled_timeframes if tf == args.resample_from else [])
+        for instrument, tf in jobs
+    ], args.jobs)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
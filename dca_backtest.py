@@ -0,0 +1,199 @@
+import itertools
+import numpy as np
+import pandas as pd
+import dateutil.parser
+from concurrent.futures import ProcessPoolExecutor
+from ohlcv_storage import make_ohlcv_storage
+from utils import period_to_seconds, timedelta
+from exchanges.backtest_exchange import load_candle_array, instrument_name_formats, cancel_after_seconds
+
+# Batch backtest of DCA schedules (the strategy of investor.py) over OHLCV archives.
+# Candles of all assets are loaded once as arrays aligned on a common time grid, then each group of parameters sharing the
+# same invest period, amounts and cancelAfter is evaluated for all limit price offsets at once with numpy.
+# Orders follow investor.py and the rules of BacktestExchange: a limit buy order is placed at an invest time at the best bid
+# of the simulated book (last close minus half the spread) lowered by limitOffset and rounded to cents, and is filled by
+# the first candle opened after it and before its expiration with a low under its price. Unlike the exchange, balances are
+# not checked: orders are never refused for insufficient funds.
+
+def load_market_data(storage, source_exchange, instruments, timeframe, start, end, cache_dir=None):
+    # instruments maps asset names to instrument names. Returns a dict with:
+    # - timestamps: open timestamps of the grid, one per timeframe from start to end
+    # - close: asset -> close prices on the grid, forward filled where a candle is missing (NaN before the first candle)
+    # - low: asset -> low prices on the grid, +inf where a candle is missing so that no order is filled there
+    step = int(timedelta(timeframe).total_seconds())
+    start = int(start) // step * step
+    timestamps = np.arange(start, int(end), step, dtype=np.int64)
+    data = { "timestamps": timestamps, "step": step, "close": {}, "low": {} }
+    for asset, instrument in instruments.items():
+        candles = load_candle_array(storage, source_exchange, instrument, timeframe, cache_dir)
+        candles = candles[(candles['open_timestamp'] >= timestamps[0]) & (candles['open_timestamp'] <= timestamps[-1])]
+        idx = (candles['open_timestamp'] - timestamps[0]) // step
+        close = np.full(len(timestamps), np.nan)
+        close[idx] = candles['close']
+        # forward fill: each slot takes the close of the last slot with a candle
+        last_valid = np.maximum.accumulate(np.where(np.isnan(close), -1, np.arange(len(close))))
+        close = np.where(last_valid >= 0, close[np.maximum(last_valid, 0)], np.nan)
+        low = np.full(len(timestamps), np.inf)
+        low[idx] = candles['low']
+        data["close"][asset] = close
+        data["low"][asset] = low
+    return data
+
+def simulate_dca(data, invest_period, invest_origin, cancel_after, invest_amount, limit_offsets, fee=0.0, spread=0.0, curve_period=86400):
+    # Simulate a DCA schedule for several limit price offsets (fraction under the best bid, see investor.py limitOffset).
+    # spread is the relative spread of the simulated order book around the last close, as in BacktestExchange.
+    # Returns a dict of arrays with a first axis of len(limit_offsets):
+    # - order_count, fill_count, fill_delay (mean seconds between the order and its fill): fill statistics
+    # - invested (fiat spent with fees), value (value of bought assets): equity curves sampled every curve_period seconds
+    # - curve_timestamps: timestamps of the samples
+    timestamps, step = data["timestamps"], data["step"]
+    invest_period, invest_origin, cancel_after, curve_period = int(invest_period), int(invest_origin), int(cancel_after), int(curve_period)
+    grid_end = timestamps[-1] + step
+    offsets = np.asarray(limit_offsets, dtype=np.float64)
+    window = max(1, int(cancel_after // step))
+
+    # Invest times after the first candle of the grid, so that a previous close is known
+    first = int(np.ceil((timestamps[0] + step - invest_origin) / invest_period))
+    invest_times = invest_origin + invest_period * np.arange(first, int(np.ceil((grid_end - invest_origin) / invest_period)))
+    invest_times = invest_times[invest_times < grid_end]
+    price_idx = (invest_times - timestamps[0]) // step - 1 # last candle closed before the invest time
+    fill_start = -((timestamps[0] - invest_times) // step) # first candle opened at or after the invest time
+
+    sample_idx = np.arange(max(0, curve_period // step - 1), len(timestamps), max(1, curve_period // step))
+    curve_timestamps = timestamps[sample_idx] + step
+    invested = np.zeros((len(offsets), len(sample_idx)))
+    value = np.zeros((len(offsets), len(sample_idx)))
+    order_count = np.zeros(len(offsets), dtype=np.int64)
+    fill_count = np.zeros(len(offsets), dtype=np.int64)
+    fill_delay = np.zeros(len(offsets))
+
+    for asset, amount in invest_amount.items():
+        close, low = data["close"][asset], data["low"][asset]
+        last_close = close[price_idx]
+        valid = ~np.isnan(last_close)
+        if not valid.any():
+            continue
+        last_close, starts = last_close[valid], fill_start[valid]
+        bids = last_close[None, :] * (1.0 - 0.5 * spread) * (1.0 - offsets[:, None]) # (offsets, orders)
+        # Same rounding as investor.py: price to cents, size from the price before rounding
+        prices = np.round(bids * 100) / 100
+        sizes = np.round(amount / bids * 10e7) / 10e7
+
+        # Lows of the candles each order can be filled by, +inf past the end of the grid: (orders, window)
+        padded_low = np.concatenate((low, np.full(window, np.inf)))
+        lows = padded_low[starts[:, None] + np.arange(window)[None, :]]
+        hits = lows[None, :, :] < prices[:, :, None] # (offsets, orders, window)
+        filled = hits.any(axis=2)
+        fill_idx = starts[None, :] + hits.argmax(axis=2)
+
+        units = np.where(filled, sizes, 0.0)
+        spent = np.where(filled, prices * sizes * (1.0 + fee), 0.0)
+
+        # A fill counts in the samples taken at or after the close of its candle
+        bins = np.searchsorted(sample_idx, fill_idx, side='left')
+        cumulated_units = np.zeros((len(offsets), len(sample_idx) + 1))
+        cumulated_spent = np.zeros((len(offsets), len(sample_idx) + 1))
+        rows = np.repeat(np.arange(len(offsets))[:, None], bins.shape[1], axis=1)
+        np.add.at(cumulated_units, (rows, bins), units)
+        np.add.at(cumulated_spent, (rows, bins), spent)
+        cumulated_units = np.cumsum(cumulated_units, axis=1)[:, :-1]
+        cumulated_spent = np.cumsum(cumulated_spent, axis=1)[:, :-1]
+
+        value += cumulated_units * np.nan_to_num(close[sample_idx])[None, :]
+        invested += cumulated_spent
+        order_count += len(starts)
+        fill_count += filled.sum(axis=1)
+        fill_delay += np.where(filled, (fill_idx - starts[None, :] + 1) * step, 0).sum(axis=1)
+
+    return {
+        "order_count": order_count,
+        "fill_count": fill_count,
+        "fill_delay": np.where(fill_count > 0, fill_delay / np.maximum(fill_count, 1), np.nan),
+        "invested": invested,
+        "value": value,
+        "curve_timestamps": curve_timestamps
+    }
+
+def max_drawdown(equity):
+    # Largest relative loss from a previous peak, for each row of equity
+    peaks = np.maximum.accumulate(equity, axis=-1)
+    return np.max(np.where(peaks > 0, 1.0 - equity / np.where(peaks > 0, peaks, 1.0), 0.0), axis=-1)
+
+def parameter_groups(config, grid):
+    # Parameters of the grid are lists of values of the investor config keys investPeriod, cancelAfter, investAmount and
+    # limitOffset, missing keys take their value in config (limitOffset defaults to 0 like in investor.py). Combinations only differing by limitOffset are evaluated together.
+    periods = grid.get("investPeriod", [ config["investPeriod"] ])
+    cancel_afters = grid.get("cancelAfter", [ config["cancelAfter"] ])
+    amounts = grid.get("investAmount", [ config["investAmount"] ])
+    offsets = grid.get("limitOffset", [ config.get("limitOffset", 0.0) ])
+    return [
+        { "investPeriod": p, "cancelAfter": c, "investAmount": a, "limitOffset": offsets }
+        for p, c, a in itertools.product(periods, cancel_afters, amounts)
+    ]
+
+_market_data = None
+
+def _init_worker(data):
+    global _market_data
+    _market_data = data
+
+def _evaluate_group(group, invest_origin, fee, spread, curve_period):
+    result = simulate_dca(_market_data, period_to_seconds(group["investPeriod"]), invest_origin,
+        cancel_after_seconds[group["cancelAfter"]], group["investAmount"], group["limitOffset"], fee, spread, curve_period)
+    rows = []
+    equity = result["invested"][:, -1:] - result["invested"] + result["value"] # cash not invested yet is kept
+    drawdowns = max_drawdown(equity)
+    for i, offset in enumerate(group["limitOffset"]):
+        invested = result["invested"][i, -1]
+        value = result["value"][i, -1]
+        rows.append({
+            "investPeriod": group["investPeriod"],
+            "cancelAfter": group["cancelAfter"],
+            "investAmount": ",".join("{}:{}".format(k, v) for k, v in sorted(group["investAmount"].items())),
+            "limitOffset": offset,
+            "orders": int(result["order_count"][i]),
+            "fills": int(result["fill_count"][i]),
+            "fillRate": result["fill_count"][i] / result["order_count"][i] if result["order_count"][i] > 0 else np.nan,
+            "meanFillDelay": result["fill_delay"][i],
+            "invested": invested,
+            "value": value,
+            "return": value / invested - 1.0 if invested > 0 else np.nan,
+            "maxDrawdown": drawdowns[i]
+        })
+    curves = [
+        pd.DataFrame({ "invested": result["invested"][i], "value": result["value"][i] },
+            index=pd.Index(result["curve_timestamps"], name="timestamp_utc"))
+        for i in range(len(group["limitOffset"]))
+    ]
+    return rows, curves
+
+def run_grid(data, config, grid, fee=0.0, spread=0.0, curve_period=86400, jobs=1):
+    # Evaluate all combinations of grid, in a pool of processes if jobs > 1.
+    # Returns a dataframe of statistics (one row per combination) and the list of equity curves in the same order.
+    invest_origin = int(dateutil.parser.parse(config["investTimeOrigin"]).timestamp())
+    groups = parameter_groups(config, grid)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(data,)) as executor:
+            results = list(executor.map(_evaluate_group, groups, [ invest_origin ] * len(groups), [ fee ] * len(groups),
+                [ spread ] * len(groups), [ curve_period ] * len(groups)))
+    else:
+        _init_worker(data)
+        results = [ _evaluate_group(g, invest_origin, fee, spread, curve_period) for g in groups ]
+    rows = [ r for group_rows, _ in results for r in group_rows ]
+    curves = [ c for _, group_curves in results for c in group_curves ]
+    return pd.DataFrame(rows), curves
+
+def load_backtest_market_data(config, grid):
+    # Market data of all the assets of the grid, from the backtest exchange section of an investor config
+    exchange_config = config["exchange"]
+    storage = make_ohlcv_storage(exchange_config.get("ohlcvFormat", "csv"), exchange_config["ohlcvFolder"])
+    source_exchange = exchange_config["sourceExchange"]
+    name_format = instrument_name_formats.get(source_exchange, "{}-{}")
+    assets = set()
+    for amounts in grid.get("investAmount", [ config["investAmount"] ]):
+        assets.update(amounts.keys())
+    instruments = { a: name_format.format(a, config["fiatCurrency"]) for a in sorted(assets) }
+    start = dateutil.parser.parse(exchange_config["startTime"]).timestamp()
+    end = dateutil.parser.parse(exchange_config["endTime"]).timestamp()
+    return load_market_data(storage, source_exchange, instruments, exchange_config.get("timeframe", "1m"), start, end,
+        exchange_config.get("cacheDir"))
@@ -1,6 +1,7 @@
 from .bitmex_exchange import BitmexExchange
 from .binance_exchange import BinanceExchange
 from .coinbasepro_exchange import CoinbaseProExchange
+from .backtest_exchange import BacktestExchange
 
 def make_bitmex_exchange():
     return BitmexExchange()
@@ -8,15 +9,18 @@ def make_bitmex_exchange():
 def make_binance_exchange():
     return BinanceExchange()
 
-def make_coinbasepro_exchange(api_key=None):
-    return CoinbaseProExchange(api_key)
+def make_coinbasepro_exchange(api_key=None, metadata_cache_dir=None, ticker_cache=False):
+    return CoinbaseProExchange(api_key, metadata_cache_dir, ticker_cache)
 
 def make_backtest_exchange(config_dict):
-    return None
+    return BacktestExchange(config_dict)
 
 def make_exchange(config_dict):
     if config_dict["name"] == "coinbasepro":
-        return make_coinbasepro_exchange(config_dict) if "apiKey" in config_dict else make_coinbasepro_exchange()
+        metadata_cache_dir = config_dict["metadataCacheDir"] if "metadataCacheDir" in config_dict else None
+        # Applications configured from a file (investor, account history) read prices repeatedly: use the ticker cache by default
+        ticker_cache = config_dict["tickerCache"] if "tickerCache" in config_dict else True
+        return make_coinbasepro_exchange(config_dict if "apiKey" in config_dict else None, metadata_cache_dir, ticker_cache)
     elif config_dict["name"] == "binance":
         return make_binance_exchange()
     elif config_dict["name"] == "bitmex":
@@ -0,0 +1,312 @@
+import os, uuid, threading
+import numpy as np
+import dateutil.parser
+from datetime import datetime, timezone
+from ohlcv_storage import make_ohlcv_storage
+from utils import timedelta
+from .crypto_assets import CryptoAssetInfo, CryptoInstrumentPairInfo
+from .clock import SimulatedClock
+
+# Exchange replaying OHLCV files written by cryptobigbro.py, with the trading interface of CoinbaseProExchange.
+# Time is given by a SimulatedClock that only moves when advance_time() is called, prices are the close of the last
+# closed candle and limit buy orders are filled when a later candle trades below their price.
+
+candle_dtype = np.dtype([
+    ('open_timestamp', np.int64),
+    ('close_timestamp', np.int64),
+    ('open', np.float64),
+    ('high', np.float64),
+    ('low', np.float64),
+    ('close', np.float64)
+])
+
+# Instruments are named like on the exchange the OHLCV files come from
+instrument_name_formats = {
+    "binance": "{}{}",
+    "bitmex": "{}{}"
+}
+
+# Coinbase Pro only accepts these values for cancel_after
+cancel_after_seconds = {
+    "min": 60,
+    "hour": 3600,
+    "day": 86400
+}
+
+def load_candle_array(storage, exchange, instrument, timeframe, cache_dir=None):
+    # Load a stored series as an array of candle_dtype.
+    # If cache_dir is provided, the array is saved there as a .npy file and memory-mapped, so that the next runs only read
+    # the candles they access. The cache is rebuilt when the series has been extended since.
+    last_close_timestamp = storage.last_close_timestamp(exchange, instrument, timeframe)
+    if last_close_timestamp == None:
+        return np.empty(0, dtype=candle_dtype)
+    if cache_dir:
+        path = os.path.join(cache_dir, "{}-{}-{}.npy".format(exchange, instrument, timeframe))
+        if os.path.exists(path):
+            array = np.load(path, mmap_mode='r')
+            if len(array) > 0 and array['close_timestamp'][-1] == last_close_timestamp:
+                return array
+    df = storage.load(exchange, instrument, timeframe).sort_index()
+    array = np.empty(len(df), dtype=candle_dtype)
+    array['open_timestamp'] = df.index.values
+    array['close_timestamp'] = df.close_timestamp_utc.values
+    for f in ('open', 'high', 'low', 'close'):
+        array[f] = df[f].values
+    if cache_dir:
+        np.save(path + ".tmp.npy", array)
+        os.replace(path + ".tmp.npy", path)
+        return np.load(path, mmap_mode='r')
+    return array
+
+def format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+class BacktestExchange:
+    # config_dict keys:
+    # - ohlcvFolder, ohlcvFormat (default csv): storage of the OHLCV files
+    # - sourceExchange: name of the exchange the files come from, eg. coinbasepro
+    # - timeframe (default 1m): timeframe of the candles used for prices and fills
+    # - startTime: beginning of the backtest
+    # - endTime (optional): end of the backtest, defaults to the end of the data
+    # - balances: initial balance of each currency, eg. { "EUR": 1000 }
+    # - makerFee (default 0): fee rate of filled orders
+    # - spread (default 0.001): relative spread of the simulated order book around the close price
+    # - cacheDir (optional): folder of memory-mapped candle arrays, see load_candle_array
+    def __init__(self, config_dict):
+        self._storage = make_ohlcv_storage(config_dict.get("ohlcvFormat", "csv"), config_dict["ohlcvFolder"])
+        self._source_exchange = config_dict["sourceExchange"]
+        self._timeframe = config_dict.get("timeframe", "1m")
+        self._instrument_name_format = instrument_name_formats.get(self._source_exchange, "{}-{}")
+        self._maker_fee = float(config_dict.get("makerFee", 0.0))
+        self._spread = float(config_dict.get("spread", 0.001))
+        self._cache_dir = config_dict.get("cacheDir")
+        if not "startTime" in config_dict:
+            raise RuntimeError("Backtest exchange config requires a startTime.")
+        self._clock = SimulatedClock(dateutil.parser.parse(config_dict["startTime"]).timestamp())
+        self._end_timestamp = dateutil.parser.parse(config_dict["endTime"]).timestamp() if "endTime" in config_dict else None
+        self._balances = { c: float(b) for c, b in config_dict["balances"].items() }
+        self._holds = { c: 0.0 for c in self._balances }
+        self._candles = {} # instrument -> candle array
+        self._orders = {} # id -> order dict, open orders and filled orders
+        self._open_order_ids = []
+        self._lock = threading.RLock()
+
+    def name(self):
+        return "backtest"
+
+    def is_authenticated(self):
+        return True
+
+    def close(self):
+        pass
+
+    # Simulated time
+
+    def get_utc_timestamp(self):
+        return int(self._clock.timestamp())
+
+    def get_utc_time(self):
+        return datetime.fromtimestamp(self.get_utc_timestamp(), timezone.utc)
+
+    def get_poll_period(self):
+        # Orders can only change state when a candle closes, polling more often is useless
+        return int(timedelta(self._timeframe).total_seconds())
+
+    def advance_time(self, seconds):
+        self._clock.advance(seconds)
+        self._update_orders()
+
+    def is_finished(self):
+        if self._end_timestamp != None:
+            return self._clock.timestamp() >= self._end_timestamp
+        # Without end time, the backtest ends when every loaded series has no more candles
+        with self._lock:
+            return len(self._candles) > 0 and all(
+                len(c) == 0 or self._clock.timestamp() >= c['close_timestamp'][-1] for c in self._candles.values())
+
+    # Market data
+
+    def _get_candles(self, instrument):
+        with self._lock:
+            if not instrument in self._candles:
+                self._candles[instrument] = load_candle_array(self._storage, self._source_exchange, instrument, self._timeframe, self._cache_dir)
+            return self._candles[instrument]
+
+    def _last_close(self, instrument):
+        candles = self._get_candles(instrument)
+        idx = np.searchsorted(candles['close_timestamp'], self._clock.timestamp(), side='right') - 1
+        if idx < 0:
+            raise RuntimeError("No candle of {} closed before {}.".format(instrument, self.get_utc_time()))
+        return float(candles['close'][idx])
+
+    def get_timeframes(self):
+        return [ self._timeframe ]
+
+    def get_instruments(self):
+        return [ i for e, i, tf in self._storage.list_series() if e == self._source_exchange and tf == self._timeframe ]
+
+    def get_assets(self):
+        return list(self._balances.keys())
+
+    def get_instrument_name(self, base, quote):
+        return self._instrument_name_format.format(base, quote)
+
+    def get_instrument_info(self, instrument):
+        if self._instrument_name_format == "{}-{}":
+            base, quote = instrument.split('-')
+        else:
+            # Without separator, the quote currency has to be one of the initial balances
+            quotes = [ c for c in self._balances if instrument.endswith(c) and len(instrument) > len(c) ]
+            if len(quotes) == 0:
+                return None
+            base, quote = instrument[:-len(quotes[0])], quotes[0]
+        return CryptoInstrumentPairInfo(instrument, self.name(), base, quote, "trading", {})
+
+    def get_asset_info(self, asset):
+        return CryptoAssetInfo(asset, 8, {})
+
+    def get_price(self, base, quote):
+        return self._last_close(self.get_instrument_name(base, quote))
+
+    def get_order_book(self, instrument, level=1):
+        # Before the first candle, an error message like Coinbase Pro for an unavailable book
+        try:
+            price = self._last_close(instrument)
+        except RuntimeError as e:
+            return { "message": str(e) }
+        # A single level on each side of the close price, in the format of Coinbase Pro
+        return {
+            "sequence": self.get_utc_timestamp(),
+            "bids": [ [ str(price * (1.0 - 0.5 * self._spread)), "1", 1 ] ],
+            "asks": [ [ str(price * (1.0 + 0.5 * self._spread)), "1", 1 ] ]
+        }
+
+    def get_order_books(self, instruments, level=1):
+        return { i: self.get_order_book(i, level) for i in instruments }
+
+    def clamp_to_min_max(self, instrument, size):
+        return size
+
+    # Accounts
+
+    def _account(self, currency):
+        balance = self._balances.get(currency, 0.0)
+        hold = self._holds.get(currency, 0.0)
+        return { "id": currency, "currency": currency, "balance": balance, "available": balance - hold, "hold": hold }
+
+    def get_accounts(self):
+        with self._lock:
+            return [ self._account(c) for c in sorted(self._balances.keys()) ]
+
+    def get_account(self, account_id):
+        with self._lock:
+            return self._account(account_id)
+
+    # Orders, in the format of Coinbase Pro
+
+    def place_buy_order(self, instrument, price, size, post_only, time_in_force, cancel_after):
+        with self._lock:
+            info = self.get_instrument_info(instrument)
+            if info == None:
+                return { "message": "Product not found" }
+            price, size = float(price), float(size)
+            cost = price * size * (1.0 + self._maker_fee)
+            if cost > self._account(info.quote_asset)["available"]:
+                return { "message": "Insufficient funds" }
+            now = self._clock.timestamp()
+            order = {
+                "id": str(uuid.uuid4()),
+                "price": str(price),
+                "size": str(size),
+                "product_id": instrument,
+                "side": "buy",
+                "type": "limit",
+                "time_in_force": time_in_force,
+                "post_only": post_only,
+                "created_at": format_timestamp(now),
+                "fill_fees": "0",
+                "filled_size": "0",
+                "executed_value": "0",
+                "status": "pending",
+                "settled": False
+            }
+            book = self.get_order_book(instrument)
+            if not "asks" in book:
+                return book
+            if post_only and price >= float(book["asks"][0][0]):
+                order["status"] = "rejected"
+                order["reject_reason"] = "post only"
+                return order
+            order["_created"] = now
+            order["_expire"] = now + cancel_after_seconds[cancel_after] if time_in_force == "GTT" else None
+            order["_quote"] = info.quote_asset
+            order["_base"] = info.base_asset
+            order["_hold"] = cost
+            self._holds[info.quote_asset] = self._holds.get(info.quote_asset, 0.0) + cost
+            self._orders[order["id"]] = order
+            self._open_order_ids.append(order["id"])
+            result = self._public_order(order)
+            order["status"] = "open"
+            return result
+
+    def _public_order(self, order):
+        return { k: v for k, v in order.items() if not k.startswith("_") }
+
+    def _fill(self, order, timestamp):
+        price, size = float(order["price"]), float(order["size"])
+        fee = price * size * self._maker_fee
+        self._holds[order["_quote"]] = max(0.0, self._holds[order["_quote"]] - order["_hold"])
+        self._balances[order["_quote"]] -= price * size + fee
+        self._balances[order["_base"]] = self._balances.get(order["_base"], 0.0) + size
+        order.update({
+            "status": "done",
+            "done_reason": "filled",
+            "done_at": format_timestamp(timestamp),
+            "fill_fees": str(fee),
+            "filled_size": order["size"],
+            "executed_value": str(price * size),
+            "settled": True
+        })
+
+    def _cancel(self, order):
+        self._holds[order["_quote"]] = max(0.0, self._holds[order["_quote"]] - order["_hold"])
+        del self._orders[order["id"]] # Coinbase Pro forgets canceled orders that were not filled
+
+    def _update_orders(self):
+        # An open order is filled by the first candle opened after its creation and closed before now with a low under its
+        # price, which is conservative for a post only order waiting at the end of the queue
+        with self._lock:
+            now = self._clock.timestamp()
+            open_order_ids = []
+            for id in self._open_order_ids:
+                order = self._orders[id]
+                candles = self._get_candles(order["product_id"])
+                last = now if order["_expire"] == None else min(now, order["_expire"])
+                begin = np.searchsorted(candles['open_timestamp'], order["_created"], side='left')
+                end = np.searchsorted(candles['close_timestamp'], last, side='right')
+                fills = np.flatnonzero(candles['low'][begin:end] < float(order["price"])) if end > begin else []
+                if len(fills) > 0:
+                    self._fill(order, candles['close_timestamp'][begin + fills[0]])
+                elif order["_expire"] != None and now >= order["_expire"]:
+                    self._cancel(order)
+                else:
+                    open_order_ids.append(id)
+            self._open_order_ids = open_order_ids
+
+    def make_order_tracker(self, instruments):
+        # Orders are updated when the simulated time advances, polling get_order is enough
+        return None
+
+    def get_order(self, id):
+        with self._lock:
+            if not id in self._orders:
+                return { "message": "NotFound" }
+            return self._public_order(self._orders[id])
+
+    def cancel_order(self, id):
+        with self._lock:
+            if not id in self._open_order_ids:
+                return { "message": "order not found" }
+            self._open_order_ids.remove(id)
+            self._cancel(self._orders[id])
+            return [ id ]
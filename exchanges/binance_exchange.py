@@ -1,16 +1,42 @@
 from binance.client import Client as BinanceClient
 import pandas as pd
 from datetime import datetime, timezone
-from utils import candle_list_to_dataframe, timedelta, compute_end_timestamp
+from utils import candle_array_to_dataframe, ticker_list_to_dataframe, timedelta, compute_end_timestamp
 from .crypto_assets import CryptoAssetInfo, CryptoInstrumentPairInfo
+from .rate_limit import TokenBucket
+from .clock import ExchangeClock
 
 # API used: https://github.com/sammchardy/python-binance
 
+# Binance allows 1200 units of request weight per minute and per IP, shared by all instances
+rate_limiter = TokenBucket(1200, 1200 / 60.0)
+
+# Column of each field in klines sent by Binance
+kline_columns = {
+    "open_timestamp": 0,
+    "open": 1,
+    "high": 2,
+    "low": 3,
+    "close": 4,
+    "volume": 5,
+    "close_timestamp": 6
+}
+
+request_weights = {
+    "exchange_info": 10,
+    "server_time": 1,
+    "klines": 1,
+    "orderbook_tickers": 2
+}
+
 class BinanceExchange:
     def __init__(self):
         self._client = BinanceClient("", "")
         self._limit = 1000
+        self._clock = ExchangeClock(self._fetch_server_timestamp)
+        rate_limiter.acquire(request_weights["exchange_info"])
         self._exchange_info = self._client.get_exchange_info()
+        self._symbols = { s["symbol"]: s for s in self._exchange_info["symbols"] }
         self._assets = {}
         for s in self._exchange_info["symbols"]:
             for k in ("baseAsset", "quoteAsset"):
@@ -20,8 +46,12 @@ class BinanceExchange:
     def name(self):
         return "binance"
 
+    def _fetch_server_timestamp(self):
+        rate_limiter.acquire(request_weights["server_time"])
+        return self._client.get_server_time()['serverTime'] / 1000
+
     def get_utc_timestamp(self):
-        return int(self._client.get_server_time()['serverTime'] / 1000)
+        return int(self._clock.timestamp())
 
     def get_utc_time(self):
         return datetime.fromtimestamp(self.get_utc_timestamp(), timezone.utc)
@@ -30,6 +60,7 @@ class BinanceExchange:
         # Binance include the current (and unfinished) bar in the fetched data, we need to compute endTime to remove it
         endTime = compute_end_timestamp(self.get_utc_time(), timeframe)
 
+        rate_limiter.acquire(request_weights["klines"])
         result = self._client.get_klines(
             symbol=instrument,
             interval=timeframe,
@@ -38,22 +69,8 @@ class BinanceExchange:
             endTime=int(endTime.timestamp() * 1000)
         )
 
-        candles = [
-            {
-                "open_datetime_utc": datetime.fromtimestamp(int(data[0] / 1000), timezone.utc),
-                "close_datetime_utc":datetime.fromtimestamp(int(data[6] / 1000), timezone.utc),
-                "open": data[1],
-                "high":data[2],
-                "low":data[3],
-                "close":data[4],
-                "volume": data[5],
-                "quote_volume": data[7],
-                "trade_count": data[8]
-            } for data in result
-        ]
+        return candle_array_to_dataframe(result, kline_columns, timestamp_divisor=1000)
 
-        return candle_list_to_dataframe(candles)
-    
     def get_timeframes(self):
         return [
             BinanceClient.KLINE_INTERVAL_1MONTH,
@@ -80,11 +97,27 @@ class BinanceExchange:
         return self._assets.keys()
 
     def get_instrument_info(self, instrument):
-        info = self._client.get_symbol_info(instrument)
+        # From the exchange info loaded at construction, python-binance get_symbol_info would download it again
+        info = self._symbols.get(instrument)
+        if info == None:
+            return None
         return CryptoInstrumentPairInfo(info["symbol"], self.name(), info["baseAsset"], info["quoteAsset"], "trading" if info["status"] == "TRADING" else "break", info)
     
     def get_asset_info(self, asset):
         return self._assets[asset]
     
     def get_tickers(self):
-        return self._client.get_orderbook_tickers()
\ No newline at end of file
+        rate_limiter.acquire(request_weights["orderbook_tickers"])
+        tickers = self._client.get_orderbook_tickers()
+        now = self.get_utc_time() # Binance book tickers have no time
+        return ticker_list_to_dataframe([
+            {
+                "instrument": t["symbol"],
+                "bid": t["bidPrice"],
+                "bid_size": t["bidQty"],
+                "ask": t["askPrice"],
+                "ask_size": t["askQty"],
+                "last": None,
+                "time": now
+            } for t in tickers
+        ])
\ No newline at end of file
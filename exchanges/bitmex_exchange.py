@@ -1,31 +1,83 @@
 import pandas as pd
 import requests
+import time, random
 from datetime import datetime, timezone
 
-from utils import timedelta, candle_list_to_dataframe
+from utils import timedelta, candle_list_to_dataframe, ticker_list_to_dataframe
 
 from .crypto_assets import CryptoAssetInfo, CryptoInstrumentInfo
+from .rate_limit import TokenBucket
+from .clock import ExchangeClock
+
+# Bitmex allows 30 unauthenticated requests per minute and per IP, shared by all instances
+rate_limiter = TokenBucket(30, 30 / 60.0)
+
+class BitmexTransport:
+    # HTTP transport for the Bitmex REST API:
+    # - a persistent session, so that connections are reused between requests
+    # - requests are throttled by the rate limiter, which is drained until x-ratelimit-reset when x-ratelimit-remaining reaches 0
+    # - 429 (rate limited), 5xx (overloaded) and connection errors are retried with exponential backoff and jitter
+    def __init__(self, url="https://www.bitmex.com/api/v1", max_retries=8, backoff_base=1.0, backoff_max=120.0):
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+
+    def backoff_seconds(self, attempt):
+        return min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def update_rate_limit(self, headers):
+        if not 'x-ratelimit-remaining' in headers or not 'x-ratelimit-reset' in headers:
+            return
+        if int(headers['x-ratelimit-remaining']) <= 0:
+            rate_limiter.drain(max(0, int(headers['x-ratelimit-reset']) - time.time()))
+
+    def get(self, endpoint, params=None):
+        url = self.url + endpoint
+        for attempt in range(self.max_retries + 1):
+            rate_limiter.acquire()
+            try:
+                r = self.session.get(url, params=params, timeout=30)
+            except requests.exceptions.RequestException as e:
+                print("Request to {} failed ({}), retrying.".format(url, e))
+                time.sleep(self.backoff_seconds(attempt))
+                continue
+
+            self.update_rate_limit(r.headers)
+
+            if r.status_code == 200:
+                return r.json()
+            if r.status_code == 429:
+                retry_after = float(r.headers['retry-after']) if 'retry-after' in r.headers else self.backoff_seconds(attempt)
+                print("Too many requests to {}, retrying in {} seconds.".format(url, retry_after))
+                rate_limiter.drain(retry_after)
+                continue
+            if r.status_code >= 500:
+                time.sleep(self.backoff_seconds(attempt))
+                continue
+            raise RuntimeError("Unable to reach {}: {} {}.".format(url, r.status_code, r.text))
+        raise RuntimeError("Unable to reach {} after {} retries.".format(url, self.max_retries))
+
+transport = BitmexTransport()
 
 def bitmex_request_get(endpoint, params=None):
-        url = "https://www.bitmex.com/api/v1" + endpoint
-        r = requests.get(url, params=params)
-        # print(r.headers['x-ratelimit-limit'])
-        # print(r.headers['x-ratelimit-remaining'])
-        # print(r.headers['x-ratelimit-reset'])
-        if r.status_code != 200:
-            raise RuntimeError("Unable to reach {}.".format(url))
-        return r.json()
+    return transport.get(endpoint, params=params)
 
 class BitmexExchange:
     def __init__(self):
         self._limit = 750 # Max number of candles that bitmex is sending
+        self._clock = ExchangeClock(self._fetch_server_timestamp)
         self._instrument_info = { _["symbol"]: _ for _ in bitmex_request_get("/instrument/active") }
     def name(self):
         return "bitmex"
 
-    def get_utc_timestamp(self):
+    def _fetch_server_timestamp(self):
         j = bitmex_request_get("")
-        return int(j["timestamp"] / 1000)
+        return j["timestamp"] / 1000
+
+    def get_utc_timestamp(self):
+        return int(self._clock.timestamp())
     
     def get_utc_time(self):
         return datetime.fromtimestamp(self.get_utc_timestamp(), timezone.utc)
@@ -42,12 +94,7 @@ class BitmexExchange:
             ('startTime', str(closeDate))
         )
 
-        try:
-            result = bitmex_request_get("/trade/bucketed", params=params)
-        except e:
-            print(e)
-            print("To many requests, try again later.")
-            result = []
+        result = bitmex_request_get("/trade/bucketed", params=params)
 
         for r in result:
             r['timestamp'] = datetime.strptime(r['timestamp'].split(".")[0] + " UTC", '%Y-%m-%dT%H:%M:%S %Z').replace(tzinfo=timezone.utc)
@@ -61,7 +108,7 @@ class BitmexExchange:
             candle["trade_count"] = candle["trades"]
 
         return candle_list_to_dataframe(candles)
-    
+
     def get_assets(self):
         return []
 
@@ -76,6 +123,16 @@ class BitmexExchange:
         return CryptoInstrumentInfo(info["symbol"], self.name(), "trading" if info["state"] == "Open" else "break", info)
     
     def get_tickers(self):
-        return [
-            bitmex_request_get("/orderBook/L2", params=(('symbol', instrument),('depth', "1"),)) for instrument,info in self._instrument_info.items() if info["state"] == "Open"
-        ]
\ No newline at end of file
+        # A single request gives the best bid/ask of all active instruments, we use it to refresh instrument info too
+        self._instrument_info = { _["symbol"]: _ for _ in bitmex_request_get("/instrument/active") }
+        return ticker_list_to_dataframe([
+            {
+                "instrument": instrument,
+                "bid": info["bidPrice"],
+                "bid_size": None,
+                "ask": info["askPrice"],
+                "ask_size": None,
+                "last": info["lastPrice"],
+                "time": info["timestamp"]
+            } for instrument, info in self._instrument_info.items() if info["state"] == "Open"
+        ])
\ No newline at end of file
@@ -0,0 +1,27 @@
+import threading
+from cbpro.cbpro_auth import ServerClock
+
+class ExchangeClock(ServerClock):
+    # Serve the time of an exchange from the local clock and a measured offset, instead of requesting the exchange each time.
+    # The offset is measured on first use, then again every resync_period seconds.
+    # fetch_server_timestamp is a callable returning the server UTC timestamp in seconds (float allowed).
+    # The implementation is shared with the clock signing Coinbase Pro requests in cbpro.
+    pass
+
+class SimulatedClock:
+    # Clock of a backtest: time only moves when advance() or set() is called, so that a replay does not wait on the wall clock.
+    def __init__(self, start_timestamp):
+        self._timestamp = float(start_timestamp)
+        self._lock = threading.Lock()
+
+    def advance(self, seconds):
+        with self._lock:
+            self._timestamp += seconds
+
+    def set(self, timestamp):
+        with self._lock:
+            self._timestamp = max(self._timestamp, float(timestamp))
+
+    def timestamp(self):
+        with self._lock:
+            return self._timestamp
@@ -1,21 +1,62 @@
-import cbpro, json
+import cbpro, json, os, time, threading
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from utils import timedelta, candle_list_to_dataframe, compute_end_timestamp
+from utils import timedelta, candle_array_to_dataframe, ticker_list_to_dataframe, compute_end_timestamp
 from .crypto_assets import CryptoAssetInfo, CryptoInstrumentPairInfo
+from .rate_limit import TokenBucket, RateLimitedSession
+from .clock import ExchangeClock
+from .metadata_cache import MetadataCache
+from .order_tracker import CoinbaseProOrderTracker
+from .ticker_cache import CoinbaseProTickerCache
 
 # API used: https://github.com/danpaquin/coinbasepro-python
 
+# Coinbase Pro allows 3 public requests per second and per IP, with bursts up to 6 requests
+rate_limiter = TokenBucket(6, 3)
+# and 5 private requests per second and per API key, with bursts up to 10 requests
+private_rate_limiter = TokenBucket(10, 5)
+
+# Column of each field in historic rates sent by Coinbase Pro
+rate_columns = {
+    "open_timestamp": 0,
+    "low": 1,
+    "high": 2,
+    "open": 3,
+    "close": 4,
+    "volume": 5
+}
+
 def format_account_dict(a):
     for k in ['available', 'balance', 'hold']:
         a[k] = float(a[k])
     return a
 
+# Delay before restarting the ticker cache after a websocket failure, prices come from the REST API meanwhile
+ticker_cache_restart_delay = 10
+
 class CoinbaseProExchange:
-    def __init__(self, api_key=None):
+    # With ticker_cache, prices and level 1 order books are read from a CoinbaseProTickerCache subscribed to the instruments
+    # on their first request, as long as their last ticker is younger than ticker_max_age seconds (book_max_age for order books)
+    def __init__(self, api_key=None, metadata_cache_dir=None, ticker_cache=False, ticker_max_age=30, book_max_age=5):
         self._client = cbpro.PublicClient()
+        self._client.session = RateLimitedSession(rate_limiter)
+        self._clock = ExchangeClock(self._fetch_server_timestamp)
+        # Products and currencies are rarely updated, keep them in memory (and on disk if a folder is provided) for one hour
+        self._products = MetadataCache(self._client.get_products, ttl=3600,
+            cache_file=os.path.join(metadata_cache_dir, "coinbasepro-products.json") if metadata_cache_dir else None)
+        self._currencies = MetadataCache(self._client.get_currencies, ttl=3600,
+            cache_file=os.path.join(metadata_cache_dir, "coinbasepro-currencies.json") if metadata_cache_dir else None)
+        self._use_ticker_cache = ticker_cache
+        self._ticker_max_age = ticker_max_age
+        self._book_max_age = book_max_age
+        self._ticker_cache = None
+        self._ticker_cache_start = 0
+        self._ticker_cache_lock = threading.Lock()
+        self._api_key = api_key
         if api_key:
             self._private_client = cbpro.AuthenticatedClient(api_key["apiKey"], api_key["apiSecret"], api_key["passPhrase"])
+            self._private_client.session = RateLimitedSession(private_rate_limiter)
             accounts = self._private_client.get_accounts()
             if "message" in accounts:
                 raise RuntimeError(accounts["message"])
@@ -50,8 +91,11 @@ class CoinbaseProExchange:
     def is_authenticated(self):
         return self._private_client != None
 
+    def _fetch_server_timestamp(self):
+        return self._client.get_time()['epoch']
+
     def get_utc_timestamp(self):
-        return int(self._client.get_time()['epoch'])
+        return int(self._clock.timestamp())
     
     def get_utc_time(self):
         return datetime.fromtimestamp(self.get_utc_timestamp(), timezone.utc)
@@ -66,81 +110,133 @@ class CoinbaseProExchange:
             granularity=int(td.total_seconds()),
             start=since.strftime("%Y-%m-%dT%H:%M")
         )
-        try:
-            result = reversed(result) # Coinbase pro is sending candles from newest to oldest, we need to reverse that
-        except:
+        if not isinstance(result, list):
             print(result)
             print(since)
             print(since.timestamp())
-            raise
+            raise RuntimeError("Unexpected response from Coinbase Pro when fetching candles of {}.".format(instrument))
+
+        df = candle_array_to_dataframe(result, rate_columns, close_timestamp_offset=(td - td_1s).total_seconds())
+        if df.empty:
+            return df
+
+        # Coinbase pro is sending candles from newest to oldest, we need to reverse that.
+        # We also need to manually filter candles because Coinsebase Pro API might give us candles before our startDate and after our endDate
+        df = df.sort_index()
+        return df[(df.index >= int(since.timestamp())) & (df.index < int(endTime.timestamp()))]
 
-        candles = [
-            {
-                "open_datetime_utc": datetime.fromtimestamp(int(data[0]), timezone.utc),
-                "close_datetime_utc": datetime.fromtimestamp(int(data[0]), timezone.utc) + td - td_1s,
-                "open": data[3],
-                "high":data[2],
-                "low":data[1],
-                "close":data[4],
-                "volume": data[5]
-            } for data in result
-        ]
-
-        # We need to manually filter candles because Coinsebase Pro API might give us candles before our startDate and after our endDate
-        candles = [ c for c in candles if since <= c['open_datetime_utc'] < endTime ]
-
-        return candle_list_to_dataframe(candles)
-    
     def get_timeframes(self):
         return [ "1d", "6h", "1h", "15m", "5m", "1m" ]
     
     def get_instruments(self):
-        return [ _["id"] for _ in self._client.get_products() ]
+        return self._products.keys()
     
     def get_assets(self):
-        return [ _["id"] for _ in self._client.get_currencies() ]
+        return self._currencies.keys()
 
     def get_instrument_info(self, instrument):
-        products = self._client.get_products()
-        for p in products:
-            if p["id"] == instrument:
-                return CryptoInstrumentPairInfo(p["id"], self.name(), p["base_currency"], p["quote_currency"], "trading" if p["status"] == "online" else "break", p)
-        return None
+        p = self._products.get(instrument)
+        if p is None:
+            return None
+        return CryptoInstrumentPairInfo(p["id"], self.name(), p["base_currency"], p["quote_currency"], "trading" if p["status"] == "online" else "break", p)
     
     def get_asset_info(self, asset):
-        currencies = self._client.get_currencies()
-        for c in currencies:
-            if c["id"] == asset:
-                min_size = c["max_precision"]
-                frac = min_size.split(".")[1]
-                precision = 0
-                while frac[precision] == "0":
-                    precision += 1
-                return CryptoAssetInfo(c["id"], precision + 1, c)
-        return None
+        c = self._currencies.get(asset)
+        if c is None:
+            return None
+        min_size = c["max_precision"]
+        frac = min_size.split(".")[1]
+        precision = 0
+        while frac[precision] == "0":
+            precision += 1
+        return CryptoAssetInfo(c["id"], precision + 1, c)
     
-    def get_tickers(self):
-        products = self._client.get_products()
-        tickers = [
-            self._client.get_product_ticker(p["id"]) for p in products if p["status"] == "online"
-        ]
-        for t in tickers:
-            t["time"] = datetime.strptime(t['time'].split(".")[0] + " UTC", '%Y-%m-%dT%H:%M:%S %Z').replace(tzinfo=timezone.utc)
-        return tickers
+    def get_tickers(self, max_workers=4):
+        # Coinbase Pro has no bulk ticker endpoint: requests are sent concurrently and throttled by the rate limiter
+        instruments = [ p["id"] for p in self._products.values() if p["status"] == "online" ]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tickers = list(executor.map(self._client.get_product_ticker, instruments))
+        return ticker_list_to_dataframe([
+            {
+                "instrument": instrument,
+                "bid": t["bid"],
+                "bid_size": None,
+                "ask": t["ask"],
+                "ask_size": None,
+                "last": t["price"],
+                "time": t["time"]
+            } for instrument, t in zip(instruments, tickers) if "price" in t
+        ])
     
+    def _get_ticker_cache(self, instruments):
+        # Running ticker cache subscribed to instruments, None if disabled or waiting to restart after a failure
+        if not self._use_ticker_cache:
+            return None
+        with self._ticker_cache_lock:
+            cache = self._ticker_cache
+            if cache == None or not cache.is_running():
+                if time.time() - self._ticker_cache_start < ticker_cache_restart_delay:
+                    return None
+                products = list(cache.products) if cache != None else []
+                if cache != None:
+                    try:
+                        cache.close()
+                    except Exception:
+                        pass # the connection is already lost
+                cache = CoinbaseProTickerCache(products)
+                cache.start()
+                self._ticker_cache = cache
+                self._ticker_cache_start = time.time()
+        cache.subscribe(instruments)
+        return cache
+
+    def _get_cached_ticker(self, instrument, max_age):
+        cache = self._get_ticker_cache([ instrument ])
+        return cache.get(instrument, max_age) if cache != None else None
+
+    def close(self):
+        with self._ticker_cache_lock:
+            if self._ticker_cache != None:
+                try:
+                    self._ticker_cache.close()
+                except Exception as e:
+                    print("[ERROR] Unable to close the ticker cache: {}".format(e))
+                self._ticker_cache = None
+
     def get_price(self, base, quote):
-        return float(self._client.get_product_ticker(base + '-' + quote)['price'])
+        ticker = self._get_cached_ticker(base + '-' + quote, self._ticker_max_age)
+        if ticker == None:
+            ticker = self._client.get_product_ticker(base + '-' + quote)
+        return float(ticker['price'])
     
     def get_instrument_name(self, base, quote):
         return base + '-' + quote
     
     def get_order_book(self, instrument, level=1):
         return self._client.get_product_order_book(instrument, level=level)
+
+    def get_order_books(self, instruments, level=1, max_workers=4):
+        # Order books of several instruments, requested concurrently (within the rate limit) so that they form a consistent snapshot.
+        # Level 1 books are built from the ticker cache when it is fresh enough (sizes are then unknown and set to 0).
+        books = {}
+        if level == 1:
+            for i in instruments:
+                ticker = self._get_cached_ticker(i, self._book_max_age)
+                if ticker != None and "best_bid" in ticker and "best_ask" in ticker:
+                    books[i] = {
+                        "sequence": ticker["sequence"],
+                        "bids": [ [ ticker["best_bid"], ticker.get("best_bid_size", "0"), 1 ] ],
+                        "asks": [ [ ticker["best_ask"], ticker.get("best_ask_size", "0"), 1 ] ]
+                    }
+        missing = [ i for i in instruments if not i in books ]
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            books.update(zip(missing, executor.map(lambda i: self.get_order_book(i, level), missing)))
+        return books
     
     def clamp_to_min_max(self, instrument, size):
-        products = [ p for p in self._client.get_products() if p["id"] == instrument ]
-        min_size = float(products[0]["base_min_size"])
-        max_size = float(products[0]["base_max_size"])
+        product = self._products.get(instrument)
+        min_size = float(product["base_min_size"])
+        max_size = float(product["base_max_size"])
         return min(max(size, min_size), max_size)
     
     def place_buy_order(self, instrument, price, size, post_only, time_in_force, cancel_after):
@@ -150,6 +246,13 @@ class CoinbaseProExchange:
     def get_order(self, id):
         return self._private_client.get_order(id)
 
+    def make_order_tracker(self, instruments):
+        # Started tracker of the orders of the account on instruments, from the user channel of the websocket feed
+        assert(self.is_authenticated())
+        tracker = CoinbaseProOrderTracker(list(instruments), self._api_key["apiKey"], self._api_key["apiSecret"], self._api_key["passPhrase"])
+        tracker.start()
+        return tracker
+
     def cancel_order(self, id):
         return self._private_client.cancel_order(id)
     
@@ -0,0 +1,71 @@
+import os, json, time, threading
+
+class MetadataCache:
+    # In-memory index of exchange metadata (products, currencies, etc.) keyed by id.
+    # fetch is a callable returning the list of metadata dicts from the exchange, key is the field used as id.
+    # The list is downloaded on first access, then again when it is older than ttl seconds.
+    # If cache_file is provided, the list is also persisted to this json file and reloaded from it by the next runs while it is fresh.
+    def __init__(self, fetch, key="id", ttl=3600, cache_file=None):
+        self._fetch = fetch
+        self._key = key
+        self._ttl = ttl
+        self._cache_file = cache_file
+        self._items = None
+        self._timestamp = None
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, timestamp):
+        return timestamp != None and time.time() - timestamp < self._ttl
+
+    def _load_from_file(self):
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return False
+        try:
+            with open(self._cache_file, "r") as f:
+                cache = json.load(f)
+        except ValueError:
+            return False # corrupted cache file, it will be rewritten by the next refresh
+        if not self._is_fresh(cache["timestamp"]):
+            return False
+        self._set_items(cache["items"], cache["timestamp"])
+        return True
+
+    def _save_to_file(self, items):
+        if not self._cache_file:
+            return
+        folder = os.path.dirname(self._cache_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(self._cache_file + ".tmp", "w") as f:
+            json.dump({ "timestamp": self._timestamp, "items": items }, f)
+        os.replace(self._cache_file + ".tmp", self._cache_file)
+
+    def _set_items(self, items, timestamp):
+        self._items = { e[self._key]: e for e in items }
+        self._timestamp = timestamp
+
+    def refresh(self):
+        with self._lock:
+            items = self._fetch()
+            if not isinstance(items, list):
+                raise RuntimeError("Unable to fetch exchange metadata: {}".format(items))
+            self._set_items(items, time.time())
+            self._save_to_file(items)
+
+    def _ensure_fresh(self):
+        with self._lock:
+            if self._is_fresh(self._timestamp) or self._load_from_file():
+                return
+        self.refresh()
+
+    def get(self, id):
+        self._ensure_fresh()
+        return self._items.get(id)
+
+    def values(self):
+        self._ensure_fresh()
+        return list(self._items.values())
+
+    def keys(self):
+        self._ensure_fresh()
+        return list(self._items.keys())
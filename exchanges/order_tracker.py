@@ -0,0 +1,69 @@
+import threading
+import cbpro
+
+class CoinbaseProOrderTracker(cbpro.WebsocketClient):
+    # Track the state of the orders of an account from the authenticated user channel of the Coinbase Pro websocket feed,
+    # so that order updates are received as soon as they happen instead of polling the REST API for each order.
+    # get_order returns the last known state in the format of the REST API (None if nothing was received for the order), and
+    # wait_for_update blocks until a message changes an order. When the connection fails, is_running returns False and the
+    # caller should fall back to the REST API.
+    def __init__(self, products, api_key, api_secret, api_passphrase):
+        super().__init__(products=products, channels=["user"], should_print=False,
+            auth=True, api_key=api_key, api_secret=api_secret, api_passphrase=api_passphrase)
+        self._orders = {} # order id -> state dict
+        self._version = 0 # incremented on each order update
+        self._condition = threading.Condition()
+
+    def _update(self, order_id, **fields):
+        with self._condition:
+            order = self._orders.setdefault(order_id, { "id": order_id, "status": "pending", "filled_size": 0.0 })
+            for k, v in fields.items():
+                if k == "filled_size":
+                    order[k] += v
+                else:
+                    order[k] = v
+            self._version += 1
+            self._condition.notify_all()
+
+    def on_message(self, msg):
+        t = msg.get("type")
+        if t == "received":
+            self._update(msg["order_id"], product_id=msg["product_id"])
+        elif t == "open":
+            self._update(msg["order_id"], status="open")
+        elif t == "match":
+            # Only one side of a match belongs to the account in the user channel, but updating both does no harm
+            for k in ("maker_order_id", "taker_order_id"):
+                if msg.get(k) in self._orders:
+                    self._update(msg[k], filled_size=float(msg["size"]))
+        elif t == "done":
+            self._update(msg["order_id"], status="done", done_reason=msg["reason"])
+        elif t == "error":
+            self.on_error(RuntimeError(msg.get("message")), msg)
+
+    def on_error(self, e, data=None):
+        super().on_error(e, data)
+        with self._condition:
+            self._version += 1
+            self._condition.notify_all() # wake up waiters so that they switch to the REST API
+
+    def version(self):
+        with self._condition:
+            return self._version
+
+    def wait_for_update(self, version, timeout):
+        # Wait until an order changes after version (returned by version()), returns the new version
+        with self._condition:
+            self._condition.wait_for(lambda: self._version != version, timeout)
+            return self._version
+
+    def get_order(self, order_id):
+        with self._condition:
+            order = self._orders.get(order_id)
+            if order == None:
+                return None
+            if order["status"] == "done" and order.get("done_reason") == "canceled" and order["filled_size"] == 0.0:
+                return { "message": "NotFound" } # like the REST API, which forgets canceled orders without fill
+            result = dict(order)
+            result["filled_size"] = str(order["filled_size"])
+            return result
@@ -0,0 +1,30 @@
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+def iterate_ohlcv_pages(fetch_page, since, end, delay=0):
+    # Generator of candle dataframes from since to end (datetimes), one per request.
+    # fetch_page(since) returns the page of candles following since. The since of the next page is the close timestamp of
+    # the last candle of the current page, so the next request is sent by a worker thread as soon as a page is received and
+    # runs while the caller processes the current page (eg. writes it to disk).
+    # Iteration stops on an empty page or when the last candle closes at end, which saves the final empty request.
+    # delay is an additional wait in seconds before each request following the first one.
+    end_timestamp = int(end.timestamp())
+
+    def fetch(since, wait):
+        if wait > 0:
+            time.sleep(wait)
+        return fetch_page(since)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch, since, 0)
+        while future != None:
+            df = future.result()
+            future = None
+            if df.empty:
+                return
+            last_close_timestamp = int(df.close_timestamp_utc.values[-1])
+            if last_close_timestamp < end_timestamp and last_close_timestamp > since.timestamp():
+                since = datetime.fromtimestamp(last_close_timestamp, timezone.utc)
+                future = executor.submit(fetch, since, delay)
+            yield df
@@ -0,0 +1,3 @@
+# The token bucket lives in cbpro, which throttles its own REST clients with it (see cbpro.OrderBookManager), so that the
+# vendored package does not depend on the exchanges package. Exchanges import it from here.
+from cbpro.rate_limit import TokenBucket, RateLimitedSession
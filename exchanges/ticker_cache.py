@@ -0,0 +1,42 @@
+import json, time, threading
+import cbpro
+
+class CoinbaseProTickerCache(cbpro.WebsocketClient):
+    # Last price and best bid/ask of products, kept up to date from the ticker channel of the Coinbase Pro websocket feed,
+    # so that reading a price is a memory read instead of a REST request.
+    # The ticker channel only sends a message on each trade: get returns None when the last message of a product is older than
+    # max_age seconds (or was never received), and the caller should then use the REST API.
+    # Products can be added while running with subscribe.
+    def __init__(self, products):
+        super().__init__(products=list(products), channels=["ticker"], should_print=False)
+        self._tickers = {} # product -> (received timestamp, ticker message)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def subscribe(self, products):
+        with self._lock:
+            products = [ p for p in products if not p in self.products ]
+            if len(products) == 0:
+                return
+            self.products.extend(products)
+        # Before the connection is made, products are sent with the first subscription
+        if self.ws != None and self.ws.connected:
+            with self._send_lock:
+                self.ws.send(json.dumps({ 'type': 'subscribe', 'product_ids': products, 'channels': self.channels }))
+
+    def on_message(self, msg):
+        t = msg.get("type")
+        if t == "ticker" and "price" in msg:
+            with self._lock:
+                self._tickers[msg["product_id"]] = (time.time(), msg)
+        elif t == "error":
+            # Eg. an unknown product: keep the other products running
+            print('{} - data: {}'.format(msg.get("message"), msg))
+
+    def get(self, product, max_age):
+        # Last ticker message of product if fresh enough, else None
+        with self._lock:
+            entry = self._tickers.get(product)
+        if entry == None or time.time() - entry[0] > max_age:
+            return None
+        return entry[1]
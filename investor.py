@@ -2,6 +2,7 @@ import argparse, json
 from flask import Flask, render_template
 import time, threading, math
 from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 from exchanges import make_exchange
 from utils import period_to_seconds, seconds_to_days_hours_minutes_seconds
@@ -40,7 +41,21 @@ class InvestorThread(Thread):
         self.fake = config["fake"] if "fake" in config else False
         self.invest_time_origin = dateutil.parser.parse(config["investTimeOrigin"])
         self.cancel_after = config["cancelAfter"]
+        # Fraction under the best bid used as limit price, 0 to bid at the best bid
+        self.limit_offset = float(config["limitOffset"]) if "limitOffset" in config else 0.0
         self.invest_count_limit = config["investCountLimit"] if "investCountLimit" in config else 0
+        # With the backtest exchange, time is simulated: waits advance the clock of the exchange instead of sleeping
+        self.backtest = exchange.name() == "backtest"
+        self.poll_period = exchange.get_poll_period() if self.backtest else 1
+        # Orders are followed from the user channel of the websocket feed when the exchange provides it, the REST API is only
+        # requested every orderReconcilePeriod to catch missed messages
+        self.order_reconcile_period = period_to_seconds(config["orderReconcilePeriod"] if "orderReconcilePeriod" in config else "1m")
+        self.order_tracker = None
+        self.order_version = 0
+        self.last_reconcile = 0
+        # Orders of an invest cycle are prepared and placed concurrently by orderWorkers threads
+        self.order_executor = ThreadPoolExecutor(max_workers=config["orderWorkers"] if "orderWorkers" in config else 4)
+        self.last_placement_seconds = None
 
         self.get_seconds_remaining()
 
@@ -49,17 +64,28 @@ class InvestorThread(Thread):
 
         self.event = Event()
 
+    def now(self):
+        return self.exchange.get_utc_timestamp() if self.backtest else time.time()
+
+    def wait(self, seconds):
+        # Returns True if the thread has been stopped
+        if not self.backtest:
+            return self.event.wait(seconds)
+        self.exchange.advance_time(seconds)
+        if self.exchange.is_finished():
+            self.event.set()
+        return self.event.is_set()
+
     def get_seconds_remaining(self):
-        current_timestamp = time.time()
+        current_timestamp = self.now()
         seconds_since_origin = current_timestamp - self.invest_time_origin.timestamp()
         previous_period_idx = math.floor(seconds_since_origin / self.invest_period_seconds)
         next_period_timestamp = self.invest_time_origin.timestamp() + (previous_period_idx + 1) * self.invest_period_seconds
         return next_period_timestamp -  current_timestamp, datetime.fromtimestamp(next_period_timestamp)
 
-    def place_order(self, asset):
+    def place_order(self, asset, orders):
         instr = self.exchange.get_instrument_name(asset, self.fiat_currency)
-        orders = self.exchange.get_order_book(instr, level=1)
-        buy_price = float(orders['bids'][0][0]) 
+        buy_price = float(orders['bids'][0][0]) * (1.0 - self.limit_offset)
         if self.fake:
             buy_price = buy_price * 0.5 # half bid price to ensure testing for now (the order will not be immediately filled)
         buy_price_base = round(buy_price * 100) / 100
@@ -69,15 +95,41 @@ class InvestorThread(Thread):
 
         return self.exchange.place_buy_order(instrument=instr, price=buy_price_base, size=buy_size, post_only=True, time_in_force='GTT', cancel_after=self.cancel_after)
 
+    def try_place_order(self, asset, instrument, order_books):
+        # Errors are returned as a message, like the exchange does, so that other assets are still bought.
+        # The order book is fetched here if it is missing from the snapshot.
+        try:
+            orders = order_books[instrument] if instrument in order_books else self.exchange.get_order_book(instrument, level=1)
+            if not "bids" in orders:
+                return { "message": f'Unable to get order book of {instrument}: {orders.get("message")}' }
+            return self.place_order(asset, orders)
+        except Exception as e:
+            return { "message": f'Unable to place order for {asset}: {e}' }
+
     def place_orders_for_assets_to_buy(self):
         remaining_assets_to_buy = []
-        for asset in self.assets_to_buy:
-            result = self.place_order(asset)
-            if result["status"] == "pending" or result["status"] == "open":
-                self.pending_orders.append(result)
-            else:
-                logging.warning(f'Unknown status {result["status"]}')
-            logging.info("Place order<br>" + dict_to_html(result))
+        assets = list(self.assets_to_buy)
+        if len(assets) > 0:
+            start = time.time()
+            # A single snapshot of the order books, then all orders are sent concurrently
+            instruments = [ self.exchange.get_instrument_name(asset, self.fiat_currency) for asset in assets ]
+            try:
+                order_books = self.exchange.get_order_books(instruments, level=1)
+            except Exception as e:
+                logging.warning(f'Unable to get order books: {e}')
+                order_books = {}
+            order_books_seconds = time.time() - start
+            results = list(self.order_executor.map(lambda asset, instr: self.try_place_order(asset, instr, order_books), assets, instruments))
+            self.last_placement_seconds = time.time() - start
+            logging.info(f'Placed {len(assets)} orders in {self.last_placement_seconds * 1000:.0f} ms (order books {order_books_seconds * 1000:.0f} ms)')
+
+            for result in results:
+                status = result["status"] if "status" in result else result.get("message")
+                if status == "pending" or status == "open":
+                    self.pending_orders.append(result)
+                else:
+                    logging.warning(f'Unknown status {status}')
+                logging.info("Place order<br>" + dict_to_html(result))
 
         self.assets_to_buy = remaining_assets_to_buy
 
@@ -85,11 +137,45 @@ class InvestorThread(Thread):
         for order in self.pending_orders:
             try:
                 self.exchange.cancel_order(order["id"])
-            except e:
+            except Exception as e:
                 logging.error(f'{e}')
 
+    def ensure_order_tracker(self):
+        if self.order_tracker != None:
+            if self.order_tracker.is_running():
+                return
+            logging.warning(f'Order tracker stopped: {self.order_tracker.error}')
+            try:
+                self.order_tracker.close()
+            except Exception as e:
+                logging.error(f'{e}')
+        try:
+            self.order_tracker = self.exchange.make_order_tracker([ self.exchange.get_instrument_name(asset, self.fiat_currency) for asset in self.invest_amount ])
+        except Exception as e:
+            logging.error(f'Unable to start order tracker, polling orders: {e}')
+            self.order_tracker = None
+
+    def is_order_tracker_running(self):
+        return self.order_tracker != None and self.order_tracker.is_running()
+
+    def get_order_state(self, order, reconcile):
+        # Last known state of an order, from the user channel when possible and from the REST API otherwise
+        result = None
+        if not reconcile and self.is_order_tracker_running():
+            result = self.order_tracker.get_order(order["id"])
+        if result == None:
+            result = self.exchange.get_order(order["id"])
+        return result
+
+    def wait_for_order_updates(self):
+        if self.is_order_tracker_running():
+            self.order_version = self.order_tracker.wait_for_update(self.order_version, self.poll_period)
+        else:
+            self.wait(self.poll_period)
+
     def invest(self):
         logging.info("Investing {}".format(self.invest_count))
+        self.ensure_order_tracker()
         fiat_account = self.exchange.get_account(self.fiat_currency_account_id)
         if fiat_account['balance'] < self.min_fiat_currency:
             logging.error("Fiat account balance is too low")
@@ -98,11 +184,16 @@ class InvestorThread(Thread):
         self.place_orders_for_assets_to_buy()
 
         while len(self.pending_orders) > 0 and not self.event.is_set():
+            reconcile = self.now() - self.last_reconcile >= self.order_reconcile_period
+            if reconcile:
+                self.last_reconcile = self.now()
+            if self.is_order_tracker_running():
+                self.order_version = self.order_tracker.version()
             open_orders = []
             for order in self.pending_orders:
-                result = self.exchange.get_order(order["id"])
+                result = self.get_order_state(order, reconcile)
                 if "status" in result:
-                    if result["status"] == "open":
+                    if result["status"] == "open" or result["status"] == "pending":
                         open_orders.append(order)
                     else:
                         logging.info("Order filled<br>" + dict_to_html(result))
@@ -114,7 +205,8 @@ class InvestorThread(Thread):
 
             self.place_orders_for_assets_to_buy()
 
-            time.sleep(1)
+            if len(self.pending_orders) > 0:
+                self.wait_for_order_updates()
         
         self.invest_count += 1
 
@@ -125,13 +217,15 @@ class InvestorThread(Thread):
         self.assets_to_buy = []
         self.pending_orders = []
 
+        self.ensure_order_tracker()
+
         seconds, next_period_datetime = self.get_seconds_remaining()
 
         print(f'Time until first investment: {seconds} seconds')
         logging.warning(f'Time until first investment: {seconds} seconds')
 
         self.state = "waiting"
-        self.event.wait(seconds)
+        self.wait(seconds)
         while not self.event.is_set():
             self.assets_to_buy = self.invest_amount.keys()
 
@@ -139,9 +233,13 @@ class InvestorThread(Thread):
             self.invest()
 
             self.state = "waiting"
-            self.event.wait(self.invest_period_seconds)
+            seconds, next_period_datetime = self.get_seconds_remaining()
+            self.wait(seconds)
 
         self.cancel_pending_orders()
+        if self.order_tracker != None:
+            self.order_tracker.close()
+        self.order_executor.shutdown()
         logging.info("Bye !")
 
     def stop(self):
@@ -169,6 +267,7 @@ def make_flask_app(investor):
             seconds=int(seconds),
             investCount=investor.invest_count,
             investCountLimit=investor.invest_count_limit,
+            lastPlacementMilliseconds=int(investor.last_placement_seconds * 1000) if investor.last_placement_seconds != None else None,
             assetInfo=[],
             assetsToBuy=[]
         )
@@ -210,6 +309,16 @@ def main():
 
     investor = InvestorThread(exchange, config)
 
+    if investor.backtest:
+        # Replay the schedule in the simulated time of the exchange, as fast as possible
+        start = time.time()
+        investor.run()
+        print(f'Backtest of {investor.invest_count} investments until {exchange.get_utc_time()} done in {time.time() - start:.1f} seconds')
+        for a in exchange.get_accounts():
+            value = a['balance'] * exchange.get_price(a['currency'], investor.fiat_currency) if a['currency'] != investor.fiat_currency else a['balance']
+            print(f'{a["currency"]}: balance {a["balance"]}, value {value:.2f} {investor.fiat_currency}')
+        return
+
     app = make_flask_app(investor)
 
     investor.start()
@@ -218,5 +327,6 @@ def main():
 
     investor.stop()
     investor.join()
+    exchange.close()
 
 main()
\ No newline at end of file
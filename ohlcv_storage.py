@@ -0,0 +1,145 @@
+import os
+import pandas as pd
+from utils import ensure_mkdir, read_csv_last_row
+
+# Storage backends for OHLCV candle history.
+# Every backend stores dataframes indexed by open_timestamp_utc with columns close_timestamp_utc, open, high, low, close, volume,
+# identified by a (exchange, instrument, timeframe) triplet, and exposes the same methods:
+# - last_close_timestamp(exchange, instrument, timeframe): close timestamp of the last stored candle, or None
+# - append(exchange, instrument, timeframe, df): append candles more recent than the stored ones
+# - load(exchange, instrument, timeframe, start=None, end=None): load candles with open timestamp in [start, end]
+# - list_series(): list of stored (exchange, instrument, timeframe) triplets
+
+def split_series_name(name):
+    # Instrument names might contain '-' (eg. BTC-EUR on coinbasepro), but exchange names and timeframes don't
+    tokens = name.split('-')
+    return tokens[0], '-'.join(tokens[1:-1]), tokens[-1]
+
+def series_name(exchange, instrument, timeframe):
+    return exchange + "-" + instrument + "-" + timeframe
+
+def filter_time_range(df, start, end):
+    if start != None:
+        df = df[df.index >= start]
+    if end != None:
+        df = df[df.index <= end]
+    return df
+
+class CsvOhlcvStorage:
+    # One append-only csv file per series: FOLDER/EXCHANGE-INSTRUMENT-TIMEFRAME.csv
+    def __init__(self, folder):
+        self.folder = folder
+        ensure_mkdir(folder)
+
+    def name(self):
+        return "csv"
+
+    def path(self, exchange, instrument, timeframe):
+        return os.path.join(self.folder, series_name(exchange, instrument, timeframe) + ".csv")
+
+    def last_close_timestamp(self, exchange, instrument, timeframe):
+        path = self.path(exchange, instrument, timeframe)
+        if not os.path.exists(path):
+            return None
+        last_row = read_csv_last_row(path)
+        return int(float(last_row['close_timestamp_utc'])) if last_row else None
+
+    def append(self, exchange, instrument, timeframe, df):
+        path = self.path(exchange, instrument, timeframe)
+        df.to_csv(path, index_label='open_timestamp_utc', mode='a', header=not os.path.exists(path))
+
+    def load(self, exchange, instrument, timeframe, start=None, end=None):
+        path = self.path(exchange, instrument, timeframe)
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        return filter_time_range(pd.read_csv(path, index_col='open_timestamp_utc'), start, end)
+
+    def list_series(self):
+        return [
+            split_series_name(os.path.splitext(f)[0]) for f in sorted(os.listdir(self.folder)) if f.endswith(".csv")
+        ]
+
+class ParquetOhlcvStorage:
+    # One folder per series, containing one parquet file per month of open timestamps:
+    # FOLDER/EXCHANGE-INSTRUMENT-TIMEFRAME/YYYY-MM.parquet
+    # Requires pyarrow.
+    def __init__(self, folder):
+        self.folder = folder
+        ensure_mkdir(folder)
+
+    def name(self):
+        return "parquet"
+
+    def path(self, exchange, instrument, timeframe):
+        return os.path.join(self.folder, series_name(exchange, instrument, timeframe))
+
+    def partitions(self, exchange, instrument, timeframe):
+        path = self.path(exchange, instrument, timeframe)
+        if not os.path.isdir(path):
+            return []
+        return sorted([ os.path.splitext(f)[0] for f in os.listdir(path) if f.endswith(".parquet") ])
+
+    def partition_path(self, exchange, instrument, timeframe, partition):
+        return os.path.join(self.path(exchange, instrument, timeframe), partition + ".parquet")
+
+    def read_partition(self, exchange, instrument, timeframe, partition):
+        return pd.read_parquet(self.partition_path(exchange, instrument, timeframe, partition))
+
+    def last_close_timestamp(self, exchange, instrument, timeframe):
+        partitions = self.partitions(exchange, instrument, timeframe)
+        if len(partitions) == 0:
+            return None
+        df = pd.read_parquet(self.partition_path(exchange, instrument, timeframe, partitions[-1]), columns=['close_timestamp_utc'])
+        return int(df.close_timestamp_utc.values[-1]) if len(df) > 0 else None
+
+    def append(self, exchange, instrument, timeframe, df):
+        if df.empty:
+            return
+        ensure_mkdir(self.path(exchange, instrument, timeframe))
+        existing_partitions = set(self.partitions(exchange, instrument, timeframe))
+        months = pd.to_datetime(df.index, unit='s', utc=True).strftime('%Y-%m')
+        for partition, partition_df in df.groupby(months):
+            if partition in existing_partitions:
+                partition_df = pd.concat([self.read_partition(exchange, instrument, timeframe, partition), partition_df])
+                partition_df = partition_df[~partition_df.index.duplicated(keep='last')]
+            path = self.partition_path(exchange, instrument, timeframe, partition)
+            # Write to a temporary file first so that an interrupted write does not corrupt the partition
+            partition_df.to_parquet(path + ".tmp", engine='pyarrow')
+            os.replace(path + ".tmp", path)
+
+    def load(self, exchange, instrument, timeframe, start=None, end=None):
+        partitions = self.partitions(exchange, instrument, timeframe)
+        if start != None:
+            start_partition = pd.to_datetime(start, unit='s', utc=True).strftime('%Y-%m')
+            partitions = [ p for p in partitions if p >= start_partition ]
+        if end != None:
+            end_partition = pd.to_datetime(end, unit='s', utc=True).strftime('%Y-%m')
+            partitions = [ p for p in partitions if p <= end_partition ]
+        if len(partitions) == 0:
+            return pd.DataFrame()
+        df = pd.concat([ self.read_partition(exchange, instrument, timeframe, p) for p in partitions ])
+        return filter_time_range(df, start, end)
+
+    def list_series(self):
+        return [
+            split_series_name(f) for f in sorted(os.listdir(self.folder)) if os.path.isdir(os.path.join(self.folder, f))
+        ]
+
+storage_formats = {
+    "csv": CsvOhlcvStorage,
+    "parquet": ParquetOhlcvStorage
+}
+
+def make_ohlcv_storage(format, folder):
+    if not format in storage_formats:
+        raise RuntimeError("Unsupported storage format {}.".format(format))
+    return storage_formats[format](folder)
+
+def load_ohlcv_path(path, start=None, end=None):
+    # Load a single series from a path to a csv file or to a parquet series folder
+    folder, name = os.path.split(os.path.normpath(path))
+    folder = folder or "."
+    if os.path.isdir(path):
+        exchange, instrument, timeframe = split_series_name(name)
+        return ParquetOhlcvStorage(folder).load(exchange, instrument, timeframe, start, end)
+    return filter_time_range(pd.read_csv(path, index_col='open_timestamp_utc'), start, end)
@@ -3,11 +3,12 @@ import pandas as pd
 from datetime import datetime, timezone, timedelta
 from bokeh.plotting import figure, show, output_file
 import dateparser
+from ohlcv_storage import load_ohlcv_path
 
 def parse_cli_args():
     parser = argparse.ArgumentParser(description='Plot an input csv file containing OHLCV data to an html document.')
 
-    parser.add_argument("csv_file", type=str, help="Path to CSV file to plot.")
+    parser.add_argument("csv_file", type=str, help="Path to CSV file, or parquet series folder, to plot.")
     parser.add_argument("-o", "--output-file", type=str, help="Path to output html file.")
     parser.add_argument("--start", help="Start date")
     parser.add_argument("--end", help="End date")
@@ -25,8 +26,15 @@ def main():
     if args.end:
         end_dt = dateparser.parse(args.end, settings={'TIMEZONE': 'UTC'})
 
-    df = pd.read_csv(args.csv_file)
-    w = (df["open_timestamp_utc"][1] - df["open_timestamp_utc"][0]) * 1000 * 0.5 # width of a bar: half the candle bar
+    df = load_ohlcv_path(args.csv_file, start=int(start_dt.replace(tzinfo=timezone.utc).timestamp()), end=int(end_dt.replace(tzinfo=timezone.utc).timestamp())).reset_index()
+    # width of a bar: half the candle bar, from the duration of the candle itself when there is a single one
+    if len(df) > 1:
+        w = (df["open_timestamp_utc"][1] - df["open_timestamp_utc"][0]) * 1000 * 0.5
+    elif len(df) == 1:
+        w = (df["close_timestamp_utc"][0] - df["open_timestamp_utc"][0] + 1) * 1000 * 0.5
+    else:
+        print("No candle between {} and {}.".format(start_dt, end_dt))
+        return
 
     df["date"] = df["open_timestamp_utc"].map(lambda x: datetime.utcfromtimestamp(x))
  
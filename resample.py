@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+from utils import timedelta, candle_value_fields
+
+# Build candles of a timeframe from stored candles of a smaller base timeframe (eg. 1h from 1m).
+# Buckets follow compute_end_timestamp: fixed timeframes are aligned on multiples of their length since the epoch
+# (weeks start on monday), and 1M buckets are calendar months.
+
+week_origin = 4 * 24 * 3600 # 1970-01-01 is a thursday, weeks start on monday 1970-01-05
+
+def can_resample(base_timeframe, timeframe):
+    if timeframe == base_timeframe or base_timeframe == "1M":
+        return False
+    base_seconds = int(timedelta(base_timeframe).total_seconds())
+    if timeframe == "1M":
+        return 24 * 3600 % base_seconds == 0
+    seconds = int(timedelta(timeframe).total_seconds())
+    return seconds > base_seconds and seconds % base_seconds == 0
+
+def bucket_open_timestamps(open_timestamps, timeframe):
+    open_timestamps = np.asarray(open_timestamps, dtype=np.int64)
+    if timeframe == "1M":
+        return open_timestamps.astype('datetime64[s]').astype('datetime64[M]').astype('datetime64[s]').astype(np.int64)
+    seconds = int(timedelta(timeframe).total_seconds())
+    origin = week_origin if timeframe.endswith("w") else 0
+    return (open_timestamps - origin) // seconds * seconds + origin
+
+def bucket_close_timestamps(bucket_opens, timeframe):
+    if timeframe == "1M":
+        next_months = bucket_opens.astype('datetime64[s]').astype('datetime64[M]') + 1
+        return next_months.astype('datetime64[s]').astype(np.int64) - 1
+    return bucket_opens + int(timedelta(timeframe).total_seconds()) - 1
+
+def resample_ohlcv(df, timeframe, until=None):
+    # Aggregate a candle dataframe sorted by open_timestamp_utc into candles of timeframe.
+    # If until is provided, only buckets with a close timestamp <= until are returned, so that the last bucket is not written
+    # before all its base candles are known.
+    if df.empty:
+        return pd.DataFrame()
+
+    bucket_opens = bucket_open_timestamps(df.index.values, timeframe)
+    # df is sorted, so each bucket is a contiguous run of rows: aggregate all of them at once with ufunc.reduceat
+    starts = np.flatnonzero(np.concatenate(([ True ], bucket_opens[1:] != bucket_opens[:-1])))
+    ends = np.concatenate((starts[1:], [ len(df) ])) - 1
+    opens = bucket_opens[starts]
+
+    result = pd.DataFrame({
+        'close_timestamp_utc': bucket_close_timestamps(opens, timeframe),
+        'open': df['open'].values[starts],
+        'high': np.maximum.reduceat(df['high'].values, starts),
+        'low': np.minimum.reduceat(df['low'].values, starts),
+        'close': df['close'].values[ends],
+        'volume': np.add.reduceat(df['volume'].values, starts)
+    }, index=opens, columns=[ 'close_timestamp_utc' ] + candle_value_fields)
+    result.index.name = "open_timestamp_utc"
+
+    if until != None:
+        result = result[result.close_timestamp_utc <= until]
+    return result
+
+def resample_series(storage, exchange, instrument, base_timeframe, timeframe, until, base_df=None):
+    # Extend the stored series of timeframe from the stored series of base_timeframe. Only base candles after the last stored
+    # bucket are loaded, so each call only computes the new buckets. base_df can provide base candles already loaded, sorted
+    # and covering at least those candles. Returns the number of candles written.
+    last_close_timestamp = storage.last_close_timestamp(exchange, instrument, timeframe)
+    start = last_close_timestamp + 1 if last_close_timestamp != None else None
+    if base_df is None:
+        df = storage.load(exchange, instrument, base_timeframe, start=start).sort_index()
+    else:
+        df = base_df[base_df.index >= start] if start != None else base_df
+    df = resample_ohlcv(df, timeframe, until)
+    if start != None:
+        df = df[df.index >= start]
+    if df.empty:
+        return 0
+    storage.append(exchange, instrument, timeframe, df)
+    return len(df)
+
+def resample_series_list(storage, exchange, instrument, base_timeframe, timeframes, until):
+    # resample_series for several timeframes, loading the base candles once: from the earliest start of the timeframes.
+    # Returns the number of candles written for each timeframe, in the same order.
+    starts = []
+    for tf in timeframes:
+        last_close_timestamp = storage.last_close_timestamp(exchange, instrument, tf)
+        starts.append(last_close_timestamp + 1 if last_close_timestamp != None else None)
+    if len(starts) == 0:
+        return []
+    start = None if None in starts else min(starts)
+    base_df = storage.load(exchange, instrument, base_timeframe, start=start).sort_index()
+    return [ resample_series(storage, exchange, instrument, base_timeframe, tf, until, base_df) for tf in timeframes ]
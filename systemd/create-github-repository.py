@@ -14,6 +14,13 @@ def main():
     try:
         r = user.create_repo(args.name)
     except:
+        # Created by a previous run that failed before initializing the local repository
+        try:
+            user.get_repo(args.name)
+            print("Repository {} already exists".format(args.name))
+            return
+        except:
+            pass
         print("Unable to create repository {}".format(args.name))
         raise
         
@@ -1,48 +1,39 @@
 EXCHANGE=$1
-DELAY=$2
-TIMEFRAMES=$3
+TIMEFRAMES=$2
 
 source $CRYPTOBIGBRO_PATH_TO_CODE/venv/bin/activate
 
 pushd $CRYPTOBIGBRO_PATH_TO_DATA
 
-instruments=`python $CRYPTOBIGBRO_PATH_TO_CODE/cryptobigbro.py list-instruments $EXCHANGE`
+# Pull existing repositories in parallel before updating them
+ls -d $EXCHANGE-*/.git 2> /dev/null | xargs -r -n 1 dirname | xargs -r -P 8 -I {} git -C {} pull
 
-for i in ${instruments//,/ }
+# A single process fetches all instruments concurrently, creates the folders of new instruments (with their info.json)
+# and lists the folders it has updated. Requests are rate limited by the exchange classes, no delay is needed.
+python $CRYPTOBIGBRO_PATH_TO_CODE/cryptobigbro.py sweep $EXCHANGE . --per-instrument-folders --timeframes ${TIMEFRAMES} \
+    --updated-list $EXCHANGE-updated.txt
+
+# Initialise the repository of every folder without one: new instruments, and folders left behind by a previous run
+# that failed before their repository was created. They are retried on next run if the GitHub repository cannot be created.
+for REPONAME in `ls -d $EXCHANGE-*/ 2> /dev/null`
 do
-    REPONAME=$EXCHANGE-$i
-    if [ ! -d "$REPONAME" ]; then 
-        python $CRYPTOBIGBRO_PATH_TO_CODE/systemd/create-github-repository.py $CRYPTOBIGBRO_GITHUB_TOKEN $REPONAME
-        mkdir $REPONAME
-        pushd $REPONAME
-        git init
-        git remote add origin git@github.com:cryptobigbro/$REPONAME.git
-        python $CRYPTOBIGBRO_PATH_TO_CODE/cryptobigbro.py instrument-info $EXCHANGE $i > info.json
-        git add *
-        git commit -a -m "Initial commit with info.json."
-        git push -u origin master
-        popd
-
-        # For coinbasepro and bitmex copy previously fetched data #todo remove this later
-        for t in ${TIMEFRAMES//,/ }
-        do
-            if [ -f $CRYPTOBIGBRO_PATH_TO_DATA/$EXCHANGE/$EXCHANGE-$i-$t.csv ]; then
-                cp $CRYPTOBIGBRO_PATH_TO_DATA/$EXCHANGE/$EXCHANGE-$i-$t.csv $REPONAME
-                pushd $REPONAME
-                git add *
-                git commit -a -m "Add previously fetched data."
-                git push -u origin master
-                popd
-            fi
-        done
+    REPONAME=`basename $REPONAME`
+    if [ -d $REPONAME/.git ]; then
+        continue
     fi
+    python $CRYPTOBIGBRO_PATH_TO_CODE/systemd/create-github-repository.py $CRYPTOBIGBRO_GITHUB_TOKEN $REPONAME || continue
     pushd $REPONAME
-    git pull
-	python $CRYPTOBIGBRO_PATH_TO_CODE/cryptobigbro.py fetch-ohlcv $EXCHANGE . --instruments ${i} --delay ${DELAY} --timeframes ${TIMEFRAMES}
+    git init
+    git remote add origin git@github.com:cryptobigbro/$REPONAME.git
     git add *
-    git commit -a -m "Update OHLCV data."
+    git commit -m "Initial commit."
     git push -u origin master
     popd
 done
 
-popd
\ No newline at end of file
+# Commit and push updated repositories in parallel
+cat $EXCHANGE-updated.txt | xargs -r -P 8 -I {} sh -c 'test -d {}/.git && cd {} && git add * && git commit -a -m "Update OHLCV data." && git push -u origin master'
+
+rm -f $EXCHANGE-updated.txt
+
+popd
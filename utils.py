@@ -1,5 +1,6 @@
 from datetime import datetime, timezone, timedelta
 import os, logging, time, shutil
+import numpy as np
 import pandas as pd
 from threading import Thread, Event
 
@@ -28,6 +29,29 @@ def ensure_mkdir(p):
         if not os.path.isdir(p):
             raise RuntimeError("{} is not a directory.".format(p))
 
+def read_csv_last_row(path_to_csv_file, block_size=4096):
+    # Read only the header and the last line of a csv file, seeking backward from the end of the file
+    # so that the cost does not depend on the length of the history.
+    # Returns a dict mapping column names to string values, or None if the file has no data row.
+    with open(path_to_csv_file, 'rb') as f:
+        header = f.readline().rstrip(b'\r\n')
+        if not header:
+            return None
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+            if data.rstrip(b'\r\n').count(b'\n') > 0:
+                break
+    last_line = data.rstrip(b'\r\n').split(b'\n')[-1].rstrip(b'\r')
+    if position == 0 and data.rstrip(b'\r\n').count(b'\n') == 0:
+        return None # only the header is present
+    return dict(zip(header.decode().split(','), last_line.decode().split(',')))
+
 def candle_list_to_dataframe(candles):
     if len(candles) == 0:
         return pd.DataFrame()
@@ -57,13 +81,53 @@ def candle_list_to_dataframe(candles):
 
     return df
 
+candle_value_fields = [ 'open', 'high', 'low', 'close', 'volume' ]
+
+def candle_array_to_dataframe(rows, columns, timestamp_divisor=1, close_timestamp_offset=None):
+    # Build the candle dataframe in one pass from the raw list of lists sent by an exchange, without creating per candle objects.
+    # 'columns' maps 'open_timestamp', 'close_timestamp' and each of candle_value_fields to a column index of rows.
+    # Timestamps of rows are divided by timestamp_divisor to get seconds (eg. 1000 for milliseconds).
+    # If close_timestamp_offset is provided, close timestamps are computed as open timestamps + close_timestamp_offset
+    # instead of being read from rows.
+    if len(rows) == 0:
+        return pd.DataFrame()
+
+    data = np.array(rows, dtype=object)
+
+    open_timestamps = data[:, columns['open_timestamp']].astype(np.int64) // timestamp_divisor
+    if close_timestamp_offset is None:
+        close_timestamps = data[:, columns['close_timestamp']].astype(np.int64) // timestamp_divisor
+    else:
+        close_timestamps = open_timestamps + int(close_timestamp_offset)
+
+    values = data[:, [ columns[f] for f in candle_value_fields ]].astype(np.float64)
+
+    df = pd.DataFrame(values, index=open_timestamps, columns=candle_value_fields)
+    df.insert(0, 'close_timestamp_utc', close_timestamps)
+    df.index.name = "open_timestamp_utc"
+
+    return df
+
+ticker_fields = [ 'bid', 'bid_size', 'ask', 'ask_size', 'last', 'time' ]
+
+def ticker_list_to_dataframe(tickers):
+    # Normalized ticker table shared by all exchanges: one row per instrument, prices and sizes as floats (NaN when the exchange
+    # does not provide them) and time as an UTC datetime
+    df = pd.DataFrame(tickers, columns=['instrument'] + ticker_fields).set_index('instrument')
+    for f in ticker_fields[:-1]:
+        df[f] = df[f].astype(np.float64)
+    df['time'] = pd.to_datetime(df['time'], utc=True)
+    return df
+
 def compute_end_timestamp(exchange_now, timeframe):
     if timeframe == "1M":
         # Special case for month because it has not fixed timedelta
         return datetime(exchange_now.year, exchange_now.month, 1, tzinfo=timezone.utc) - timedelta('1s')
 
     td = timedelta(timeframe)
-    start_of_current_bar = int(exchange_now.timestamp() / td.total_seconds()) * td.total_seconds()
+    # Weeks start on monday, 1970-01-05 (the epoch is a thursday)
+    origin = 4 * 24 * 3600 if timeframe.endswith("w") else 0
+    start_of_current_bar = int((exchange_now.timestamp() - origin) / td.total_seconds()) * td.total_seconds() + origin
     return datetime.fromtimestamp(start_of_current_bar, timezone.utc) - timedelta('1s')
 
 def string_list_arg(string):